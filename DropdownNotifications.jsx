@@ -2,27 +2,32 @@ import React, { useState, useRef, useEffect } from 'react';
 import { Link } from 'react-router-dom';
 import Transition from '../utils/Transition';
 
+const NOTIFICATIONS_URL = import.meta.env.VITE_NOTIFICATIONS_URL || '/notifications.json';
+const POLL_INTERVAL_MS = 60000;
+
 function DropdownNotifications({ align }) {
   const [dropdownOpen, setDropdownOpen] = useState(false);
   const [notifications, setNotifications] = useState([]);
   const trigger = useRef(null);
   const dropdown = useRef(null);
 
-  // Fetch notifications from the JSON file
+  // Fetch notifications from the JSON file (or the notification_feed.py server), revalidating on every poll
   useEffect(() => {
-    fetch('/notifications.json')
-      .then((response) => {
-        console.log('Fetch response:', response); // Debugging
-        if (!response.ok) {
-          throw new Error(`HTTP error! status: ${response.status}`);
-        }
-        return response.json();
-      })
-      .then((data) => {
-        console.log('Notifications data:', data); // Debugging
-        setNotifications(data);
-      })
-      .catch((error) => console.error('Error fetching notifications:', error));
+    const fetchNotifications = () => {
+      // 'no-cache' sends the stored ETag, so an unchanged feed answers 304 and the cached copy is reused
+      fetch(NOTIFICATIONS_URL, { cache: 'no-cache' })
+        .then((response) => {
+          if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+          }
+          return response.json();
+        })
+        .then((data) => setNotifications(data))
+        .catch((error) => console.error('Error fetching notifications:', error));
+    };
+    fetchNotifications();
+    const interval = setInterval(fetchNotifications, POLL_INTERVAL_MS);
+    return () => clearInterval(interval);
   }, []);
 
   // Close on click outside
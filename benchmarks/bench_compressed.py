@@ -0,0 +1,76 @@
+"""Decompress+parse throughput of gzip and zstd energy logs against the same log in plain text.
+
+Run from the repository root:
+
+    python3 benchmarks/bench_compressed.py --lines 2000000
+"""
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_parser import write_synthetic_log
+from log_index import open_log, read_last_stamp, zstandard
+from power_log_merge import iter_log_blocks
+
+
+def compress(text_path):
+    """Write .gz and, if zstandard is installed, .zst copies of a log; return all the paths."""
+    paths = [text_path]
+    with open(text_path, 'rb') as source, gzip.open(f"{text_path}.gz", 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+    paths.append(f"{text_path}.gz")
+    if zstandard is not None:
+        with open(text_path, 'rb') as source, open(f"{text_path}.zst", 'wb') as target:
+            zstandard.ZstdCompressor(level=3).copy_stream(source, target)
+        paths.append(f"{text_path}.zst")
+    return paths
+
+
+def best_time(function, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        text_path = os.path.join(folder_path, 'EnergyTextFile.txt')
+        n_lines = write_synthetic_log(text_path, args.lines)
+        text_size = os.path.getsize(text_path)
+        print(f"{n_lines} lines, {text_size / 2 ** 20:.0f} MiB of text")
+        if zstandard is None:
+            print("zstandard is not installed, skipping .zst")
+
+        expected = None
+        plain_rate = None
+        for path in compress(text_path):
+            def parse():
+                with open_log(path) as file:
+                    return list(iter_log_blocks(file))
+
+            blocks, elapsed = best_time(parse, args.repeats)
+            _, last_elapsed = best_time(lambda: read_last_stamp(path), args.repeats)
+            expected = expected or blocks
+            plain_rate = plain_rate or n_lines / elapsed
+            print(f"{os.path.basename(path):<24} {os.path.getsize(path) / 2 ** 20:>6.1f} MiB  "
+                  f"{n_lines / elapsed:>12,.0f} lines/s ({text_size / elapsed / 2 ** 20:,.0f} MiB/s of text, "
+                  f"{n_lines / elapsed / plain_rate:.2f}x plain)  last timestamp {last_elapsed * 1000:.1f} ms"
+                  f"{'' if blocks == expected else '  BLOCKS DIFFER'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Export speed of get_data's output formats against the old fetchall + pandas to_excel path.
+
+Run from the repository root against a database with data in the chosen range:
+
+    python3 benchmarks/bench_export.py --schema smrvid --table scans \
+        --columns start_time,scan_length,protocol --start 2024-01-01 --end 2024-12-31
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import get_connection
+from main import build_query, get_data
+
+
+def legacy_get_data(schema, table, columns, start_date, end_date, excel_file_path):
+    """The fetchall/DataFrame/to_excel export that get_data replaced, kept as the baseline."""
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(build_query(schema, table, columns), (start_date, end_date))
+        df = pd.DataFrame(cursor.fetchall(), columns=columns[1:] + ['date'])
+        df.to_excel(excel_file_path, index=False)
+        cursor.close()
+    return len(df)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--schema', default='smrvid')
+    parser.add_argument('--table', default='scans')
+    parser.add_argument('--columns', default='start_time,scan_length,protocol', help="comma-separated column names")
+    parser.add_argument('--start', default='2024-01-01')
+    parser.add_argument('--end', default='2024-12-31')
+    parser.add_argument('--formats', default='to_excel,xlsx,csv,parquet,arrow')
+    args = parser.parse_args()
+
+    columns = ['id'] + args.columns.split(',')
+    with tempfile.TemporaryDirectory() as folder:
+        baseline = None
+        for fmt in args.formats.split(','):
+            file_path = os.path.join(folder, f"export.{'xlsx' if fmt == 'to_excel' else fmt}")
+            start = time.perf_counter()
+            if fmt == 'to_excel':
+                rows = legacy_get_data(args.schema, args.table, columns, args.start, args.end, file_path)
+            else:
+                rows = get_data(args.schema, args.table, columns, args.start, args.end, file_path, fmt=fmt)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+
+            print(f"{fmt:>8}: {rows} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s, "
+                  f"{baseline / elapsed:.1f}x), {os.path.getsize(file_path) / 2 ** 20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
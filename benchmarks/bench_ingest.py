@@ -0,0 +1,68 @@
+"""Parallel ingestion of a whole log directory against sequential process_log_file calls.
+
+Run from the repository root:
+
+    python3 benchmarks/bench_ingest.py --files 100 --lines 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_parser import write_synthetic_log
+from log_index import LogIndex
+from power_log_merge import process_log_file, process_log_directory
+
+
+def write_synthetic_directory(folder_path, n_files, lines_per_file, seed=0):
+    """Write one long synthetic log cut into n_files files at random lines, so blocks run across files."""
+    log_path = os.path.join(folder_path, 'full.log')
+    write_synthetic_log(log_path, n_files * lines_per_file, seed)
+    with open(log_path, 'r') as file:
+        lines = file.readlines()
+    os.remove(log_path)
+
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(lines)), n_files - 1))
+    for i, (start, stop) in enumerate(zip([0] + cuts, cuts + [len(lines)])):
+        with open(os.path.join(folder_path, f"EnergyTextFile_{i:04d}.txt"), 'w') as file:
+            file.writelines(lines[start:stop])
+    return len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=100000, help="lines per file")
+    parser.add_argument('--workers', type=int, nargs='+', help="worker counts to time (default 1, 2, 4, ... up to the cores)")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({2 ** i for i in range(cores.bit_length())} | {cores})
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        n_lines = write_synthetic_directory(folder_path, args.files, args.lines)
+        print(f"{args.files} files, {n_lines} lines, {cores} cores")
+
+        # Each run gets a fresh index so none of them reuses the stitching data of another
+        index = LogIndex(folder_path, os.path.join(folder_path, 'sequential.json'))
+        start = time.perf_counter()
+        expected = [block for name in index.files() for block in process_log_file(os.path.join(folder_path, name), index)]
+        sequential = time.perf_counter() - start
+        print(f"sequential process_log_file: {sequential:.2f}s, {len(expected)} blocks")
+
+        for workers in worker_counts:
+            index = LogIndex(folder_path, os.path.join(folder_path, f"parallel_{workers}.json"))
+            start = time.perf_counter()
+            blocks = process_log_directory(folder_path, workers, index)
+            elapsed = time.perf_counter() - start
+            status = "identical" if blocks == expected else "DIFFERENT"
+            print(f"process_log_directory, {workers:>3} workers: {elapsed:.2f}s, {sequential / elapsed:.1f}x, {status}")
+
+
+if __name__ == '__main__':
+    main()
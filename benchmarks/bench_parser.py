@@ -0,0 +1,117 @@
+"""Throughput of the energy log parser on a synthetic EnergyTextFile.
+
+Run from the repository root:
+
+    python3 benchmarks/bench_parser.py --lines 2000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from power_log_merge import process_log_file, load_block_store, calculate_duration
+
+
+def write_synthetic_log(file_path, n_lines, seed=0):
+    """Write a log of roughly n_lines lines with a measurement block every few hundred lines."""
+    rng = random.Random(seed)
+    stamp = datetime(2024, 6, 24, 7, 0, 0)
+    written = 0
+    with open(file_path, 'w') as file:
+        while written < n_lines:
+            lines = [f"{stamp:%Y/%m/%d-%H:%M:%S.%f}|MrMeasSrv|cmdStartMeasurement|protocol started\n"]
+            energy = 0.0
+            for _ in range(rng.randint(100, 400)):
+                stamp += timedelta(milliseconds=rng.randint(50, 500))
+                if rng.random() < 0.2:
+                    energy += rng.uniform(10.0, 500.0)
+                    lines.append(f"{stamp:%Y/%m/%d-%H:%M:%S.%f}|MrMeasSrv|cmdUpdateEngInfo|energy: {energy:.3f} Ws\n")
+                else:
+                    lines.append(f"{stamp:%Y/%m/%d-%H:%M:%S.%f}|PowerMon|gradient temperature {rng.uniform(18, 30):.2f} C\n")
+            stamp += timedelta(milliseconds=rng.randint(50, 500))
+            lines.append(f"{stamp:%Y/%m/%d-%H:%M:%S.%f}|MrMeasSrv|cmdEndMeasurement|protocol finished\n")
+            file.writelines(lines)
+            written += len(lines)
+            stamp += timedelta(seconds=rng.randint(5, 120))
+    return written
+
+
+def legacy_process_log_file(file_path):
+    """The readlines()/strptime parser that process_log_file replaced, kept as the baseline."""
+    blocks = []
+    current_block = None
+    with open(file_path, 'r') as file:
+        lines = file.readlines()
+        for line in lines:
+            if "cmdStartMeasurement" in line:
+                if current_block:
+                    blocks.append(current_block)
+                current_block = {
+                    'start_time': datetime.strptime(line.split('|')[0], "%Y/%m/%d-%H:%M:%S.%f"),
+                    'total_energy': 0.0,
+                    'end_time': None,
+                    'duration': None,
+                }
+            elif "cmdUpdateEngInfo" in line and current_block:
+                current_block['total_energy'] = float(line.split("energy: ")[-1].split(" ")[0])
+            elif "cmdEndMeasurement" in line and current_block:
+                current_block['end_time'] = datetime.strptime(line.split('|')[0], "%Y/%m/%d-%H:%M:%S.%f")
+                current_block['duration'] = calculate_duration(current_block['start_time'], current_block['end_time'])
+                blocks.append(current_block)
+                current_block = None
+        if current_block:
+            blocks.append(current_block)
+    return blocks
+
+
+def time_parser(parser, file_path, n_lines, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        blocks = parser(file_path)
+        best = min(best, time.perf_counter() - start)
+    return blocks, n_lines / best
+
+
+def peak_memory(parser, file_path):
+    tracemalloc.start()
+    parser(file_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=2000000, help="approximate number of log lines")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_path = os.path.join(folder, 'EnergyTextFile.txt')
+        n_lines = write_synthetic_log(file_path, args.lines)
+
+        legacy_blocks, legacy_rate = time_parser(legacy_process_log_file, file_path, n_lines, args.repeats)
+        blocks, rate = time_parser(process_log_file, file_path, n_lines, args.repeats)
+        mmap_blocks, mmap_rate = time_parser(lambda path: process_log_file(path, use_mmap=True), file_path, n_lines, args.repeats)
+        store, store_rate = time_parser(lambda path: load_block_store(path, use_mmap=True), file_path, n_lines, args.repeats)
+        legacy_peak = peak_memory(legacy_process_log_file, file_path)
+        peak = peak_memory(process_log_file, file_path)
+
+    assert blocks == legacy_blocks, "streaming parser output differs from the legacy parser"
+    assert mmap_blocks == legacy_blocks and store.to_blocks() == legacy_blocks, "mmap parser output differs from the legacy parser"
+    print(f"{n_lines} lines, {len(blocks)} blocks")
+    print(f"legacy readlines parser: {legacy_rate:,.0f} lines/s, peak {legacy_peak:,.0f} MiB")
+    print(f"streaming parser:        {rate:,.0f} lines/s ({rate / legacy_rate:.1f}x), peak {peak:,.0f} MiB")
+    print(f"mmap parser:             {mmap_rate:,.0f} lines/s ({mmap_rate / legacy_rate:.1f}x)")
+    print(f"mmap to BlockStore:      {store_rate:,.0f} lines/s ({store_rate / legacy_rate:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
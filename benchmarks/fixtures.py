@@ -0,0 +1,145 @@
+"""Deterministic inputs for the benchmarks: synthetic energy logs and a seeded scanner schema.
+
+The same seed always gives byte-identical logs and identical rows, so timings can be compared
+between versions of the code.  The fixture schema mirrors a scanner's <scanner>.dates and
+<scanner>.scans tables, and each scan on the log day covers two consecutive blocks of the logs, so
+that merge and get_scan_energy find a match for every one of them.
+"""
+from datetime import date, datetime, timedelta
+from psycopg2 import sql
+import random
+import io
+import os
+
+FIXTURE_SCHEMA = 'bench_scanner'
+FIRST_DATE = date(2024, 1, 1)
+LOG_DATE = date(2024, 6, 24)
+PROTOCOLS = ['t1_mprage', 't2_tse', 'flair', 'dwi', 'swi', 'localizer', 'bold_rs', 'tof_angio']
+
+# merge matches times of day to within a minute, never starts a scan at the first block, and ends
+# it at a later block than the one it starts at.  So the log stays within one day, block 0 is a
+# warm-up outside any scan, each scan is a pair of blocks a few seconds apart, and consecutive
+# scans start more than a minute apart.
+GAP_IN_SCAN = (2, 10)
+GAP_BETWEEN_SCANS = (60, 75)
+
+
+def _stamp(moment):
+    return f"{moment:%Y/%m/%d-%H:%M:%S.%f}"
+
+
+def synthetic_log_lines(n_blocks, lines_per_block=200, seed=0, log_date=LOG_DATE):
+    """The lines of a day's log with n_blocks measurement blocks, and the (start, end) of each block.
+
+    Each block has about lines_per_block lines, a fifth of them cumulative cmdUpdateEngInfo energy
+    updates and the rest other scanner chatter.  Blocks 1 and 2, 3 and 4, and so on are a few
+    seconds apart and make up one scan each (see log_day_scans); the scans are a minute or more apart.
+    """
+    rng = random.Random(seed)
+    moment = datetime.combine(log_date, datetime.min.time()) + timedelta(hours=7)
+    lines, blocks = [], []
+    for _ in range(n_blocks):
+        start = moment
+        lines.append(f"{_stamp(moment)}|MrMeasSrv|cmdStartMeasurement|protocol started\n")
+        energy = 0.0
+        for _ in range(rng.randint(lines_per_block // 2, lines_per_block * 3 // 2)):
+            moment += timedelta(milliseconds=rng.randint(10, 60))
+            if rng.random() < 0.2:
+                energy += rng.uniform(10.0, 500.0)
+                lines.append(f"{_stamp(moment)}|MrMeasSrv|cmdUpdateEngInfo|energy: {energy:.3f} Ws\n")
+            else:
+                lines.append(f"{_stamp(moment)}|PowerMon|gradient temperature {rng.uniform(18, 30):.2f} C\n")
+        moment += timedelta(milliseconds=rng.randint(10, 60))
+        lines.append(f"{_stamp(moment)}|MrMeasSrv|cmdEndMeasurement|protocol finished\n")
+        blocks.append((start, moment))
+        moment += timedelta(seconds=rng.randint(*(GAP_IN_SCAN if len(blocks) % 2 == 0 else GAP_BETWEEN_SCANS)))
+
+    if blocks and blocks[-1][1].date() != log_date:
+        raise ValueError(f"{n_blocks} blocks of {lines_per_block} lines run past the end of {log_date}; use fewer")
+    return lines, blocks
+
+
+def log_day_scans(blocks):
+    """The (start, length in whole minutes) of the scans on the log day: blocks 1 and 2, 3 and 4, and so on.
+
+    A length rounded to the minute puts the scan's end within 30 seconds of its second block's end,
+    inside merge's one-minute tolerance.
+    """
+    return [
+        (first[0], max(1, round((second[1] - first[0]).total_seconds() / 60)))
+        for first, second in zip(blocks[1::2], blocks[2::2])
+    ]
+
+
+def write_synthetic_logs(folder_path, n_files, n_blocks, lines_per_block=200, seed=0, log_date=LOG_DATE):
+    """Write a day's log cut into n_files EnergyTextFile_NNNN.txt files; return (paths, block (start, end)s).
+
+    Every cut falls inside a block, so each file but the last ends with a block that continues in
+    the next one, as when a scanner rotates its log mid-measurement.
+    """
+    lines, blocks = synthetic_log_lines(n_blocks, lines_per_block, seed, log_date)
+    starts = [i for i, line in enumerate(lines) if "cmdStartMeasurement" in line]
+    ends = [i for i, line in enumerate(lines) if "cmdEndMeasurement" in line]
+
+    # One cut inside each of n_files - 1 distinct blocks
+    rng = random.Random(seed)
+    spanning = sorted(rng.sample(range(len(blocks)), min(n_files - 1, len(blocks))))
+    cuts = [rng.randint(starts[i] + 2, ends[i] - 1) for i in spanning]
+
+    paths = []
+    for i, (begin, stop) in enumerate(zip([0] + cuts, cuts + [len(lines)])):
+        paths.append(os.path.join(folder_path, f"EnergyTextFile_{i:04d}.txt"))
+        with open(paths[-1], 'w') as file:
+            file.writelines(lines[begin:stop])
+    return paths, blocks
+
+
+def scan_rows(n_days, scans_per_day, seed=0, log_scans=(), first_date=FIRST_DATE, log_date=LOG_DATE):
+    """The dates rows (id, date) and scans rows (id, date_id, start_time, scan_length, protocol) of the fixture.
+
+    Scans on log_date are log_scans, (start, length) pairs as log_day_scans() returns them; every other
+    day has scans_per_day scans spread over the working day.
+    """
+    rng = random.Random(seed)
+    dates, scans = [], []
+    for day in range(n_days):
+        date_id = day + 1
+        current = first_date + timedelta(days=day)
+        dates.append((date_id, current))
+        if current == log_date and log_scans:
+            for start, length in log_scans:
+                scans.append((len(scans) + 1, date_id, start.time(), length, rng.choice(PROTOCOLS)))
+            continue
+        moment = datetime.combine(current, datetime.min.time()) + timedelta(hours=7)
+        for _ in range(scans_per_day):
+            length = rng.randint(2, 15)
+            scans.append((len(scans) + 1, date_id, moment.time(), length, rng.choice(PROTOCOLS)))
+            moment += timedelta(minutes=length + rng.randint(0, 5))
+    return dates, scans
+
+
+def seed_database(conn, n_days=365, scans_per_day=40, seed=0, log_scans=(), schema=FIXTURE_SCHEMA):
+    """(Re)create the fixture schema with its dates and scans tables and load the seeded rows.
+
+    The schema is dropped first, so this only ever touches its own schema.  Returns the number of scans.
+    """
+    dates, scans = scan_rows(n_days, scans_per_day, seed, log_scans)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};").format(sql.Identifier(schema)))
+        cur.execute(sql.SQL("""
+            CREATE TABLE {0}.dates (id integer PRIMARY KEY, date date UNIQUE);
+            CREATE TABLE {0}.scans (id integer PRIMARY KEY, date_id integer, start_time time,
+                                    scan_length integer, protocol text);
+        """).format(sql.Identifier(schema)))
+        for table, rows in (('dates', dates), ('scans', scans)):
+            buffer = io.StringIO("".join("\t".join(str(value) for value in row) + "\n" for row in rows))
+            cur.copy_expert(sql.SQL("COPY {}.{} FROM STDIN").format(sql.Identifier(schema), sql.Identifier(table)).as_string(conn), buffer)
+        cur.execute(sql.SQL("ANALYZE {0}.dates; ANALYZE {0}.scans;").format(sql.Identifier(schema)))
+    conn.commit()
+    return len(scans)
+
+
+def drop_database_fixture(conn, schema=FIXTURE_SCHEMA):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(schema)))
+    conn.commit()
@@ -0,0 +1,200 @@
+"""Timed scenarios for the log parser, scan matching and database functions, written out as JSON.
+
+Every run uses the same deterministic synthetic logs and seeded fixture schema (see fixtures.py),
+so the JSON of two versions of the code can be compared.  Run from the repository root:
+
+    python3 benchmarks/run_benchmarks.py --output results.json
+    python3 benchmarks/run_benchmarks.py --output new.json --compare results.json
+
+The database scenarios create and drop their own schema (bench_scanner) in the database db.py
+connects to; --no-db runs only the log scenarios.
+"""
+from datetime import datetime, timedelta
+import pandas as pd
+import subprocess
+import contextlib
+import platform
+import argparse
+import tempfile
+import json
+import time
+import sys
+import io
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import FIXTURE_SCHEMA, FIRST_DATE, LOG_DATE, write_synthetic_logs, log_day_scans, seed_database, \
+    drop_database_fixture
+from db import get_connection
+from log_index import LogIndex
+from main import get_data
+from power_log_merge import process_log_file, merge_scans, get_scan_energy, extract_scans, \
+    add_energy_column, add_energy_columns
+
+
+def best_time(function, repeats):
+    """(result, best seconds, every run's seconds) of calling function repeats times, with its prints silenced."""
+    runs = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            runs.append(time.perf_counter() - start)
+    return result, min(runs), runs
+
+
+def log_scenarios(folder_path, paths, blocks, scans, repeats):
+    """process_log_file on every file, then merge_scans and get_scan_energy for every scan of the log day."""
+    results = {}
+
+    def parse_files():
+        # A new index each time, so the neighbours are read for stitching as on a first run
+        index = LogIndex(folder_path, os.path.join(folder_path, 'index.json'))
+        return [block for path in paths for block in process_log_file(path, index)]
+
+    parsed, elapsed, runs = best_time(parse_files, repeats)
+    results['process_log_file'] = {'seconds': elapsed, 'runs': runs, 'items': len(parsed), 'unit': 'blocks'}
+
+    df_scans = pd.DataFrame([(start.time(), length) for start, length in scans], columns=['start_time', 'scan_length'])
+    matches, elapsed, runs = best_time(lambda: merge_scans(parsed, df_scans, 1), repeats)
+    results['merge_scans'] = {'seconds': elapsed, 'runs': runs, 'items': len(scans), 'unit': 'scans',
+                              'matched': sum(start_idx is not None for start_idx, _ in matches)}
+
+    found = [(start_idx, end_idx) for start_idx, end_idx in matches if start_idx is not None]
+    _, elapsed, runs = best_time(lambda: [get_scan_energy(parsed, start_idx, end_idx) for start_idx, end_idx in found], repeats)
+    results['get_scan_energy'] = {'seconds': elapsed, 'runs': runs, 'items': len(found), 'unit': 'scans'}
+
+    if len(parsed) != len(blocks):
+        print(f"Warning: parsed {len(parsed)} blocks, the generator wrote {len(blocks)}")
+    return results, parsed, matches
+
+
+def database_scenarios(folder_path, parsed, matches, args):
+    """extract_scans, add_energy_column (row by row and batched) and get_data on the fixture schema.
+
+    matches maps the start time of each log day scan to its (start_idx, end_idx) in parsed.
+    """
+    results = {}
+    end_date = FIRST_DATE + timedelta(days=args.days - 1)
+
+    df_scans, elapsed, runs = best_time(lambda: extract_scans(FIXTURE_SCHEMA, LOG_DATE), args.repeats)
+    results['extract_scans'] = {'seconds': elapsed, 'runs': runs, 'items': len(df_scans), 'unit': 'scans'}
+
+    # extract_scans orders the rows by start time; pair each with the match of the scan starting then
+    updates = []
+    for _, row in df_scans.iterrows():
+        start_idx, end_idx = matches.get(row['start_time'], (None, None))
+        if start_idx is not None:
+            updates.append((int(row['date_id']), row['start_time'], get_scan_energy(parsed, start_idx, end_idx)))
+    single = updates[:args.updates]
+    _, elapsed, runs = best_time(lambda: [add_energy_column(FIXTURE_SCHEMA, 'scans', *row) for row in single], args.repeats)
+    results['add_energy_column'] = {'seconds': elapsed, 'runs': runs, 'items': len(single), 'unit': 'rows'}
+
+    _, elapsed, runs = best_time(lambda: add_energy_columns(FIXTURE_SCHEMA, 'scans', updates), args.repeats)
+    results['add_energy_columns'] = {'seconds': elapsed, 'runs': runs, 'items': len(updates), 'unit': 'rows'}
+
+    columns = ['id', 'start_time', 'scan_length', 'protocol']
+    for fmt in args.formats.split(','):
+        file_path = os.path.join(folder_path, f"export.{fmt}")
+        rows, elapsed, runs = best_time(
+            lambda: get_data(FIXTURE_SCHEMA, 'scans', columns, FIRST_DATE, end_date, file_path, fmt=fmt),
+            args.repeats
+        )
+        results[f"get_data_{fmt}"] = {'seconds': elapsed, 'runs': runs, 'items': rows, 'unit': 'rows'}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Print each scenario's time against a previous run; return the names that got slower than threshold."""
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+    print(f"\nAgainst {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    regressions = []
+    for name, result in results['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None or previous['items'] != result['items']:
+            print(f"{name:>20}: not comparable")
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        slower = ratio > threshold
+        print(f"{name:>20}: {ratio:.2f}x the time{'  REGRESSION' if slower else ''}")
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20, help="log files the day's log is cut into")
+    parser.add_argument('--blocks', type=int, default=1000, help="measurement blocks in the day's log")
+    parser.add_argument('--lines-per-block', type=int, default=400)
+    parser.add_argument('--days', type=int, default=365, help="days of scans in the fixture schema")
+    parser.add_argument('--scans-per-day', type=int, default=40)
+    parser.add_argument('--updates', type=int, default=200, help="rows updated one at a time by add_energy_column")
+    parser.add_argument('--formats', default='csv,xlsx', help="get_data output formats to time")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-db', action='store_true', help="skip the scenarios that need the database")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="a previous results JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=1.2, help="slowdown that counts as a regression (default 1.2x)")
+    args = parser.parse_args()
+    if not args.no_db and FIRST_DATE + timedelta(days=args.days - 1) < LOG_DATE:
+        parser.error(f"--days must reach the log day, {LOG_DATE} ({(LOG_DATE - FIRST_DATE).days + 1} days)")
+
+    results = {
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'threshold')},
+        'scenarios': {},
+    }
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        log_path = os.path.join(folder_path, 'logs')
+        os.makedirs(log_path)
+        paths, blocks = write_synthetic_logs(log_path, args.files, args.blocks, args.lines_per_block, args.seed)
+        scans = log_day_scans(blocks)
+
+        log_results, parsed, matches = log_scenarios(log_path, paths, blocks, scans, args.repeats)
+        results['scenarios'].update(log_results)
+
+        if not args.no_db:
+            try:
+                with get_connection() as conn:
+                    seed_database(conn, args.days, args.scans_per_day, args.seed, scans)
+                try:
+                    matched = {start.time(): match for (start, _), match in zip(scans, matches)}
+                    results['scenarios'].update(database_scenarios(folder_path, parsed, matched, args))
+                finally:
+                    with get_connection() as conn:
+                        drop_database_fixture(conn)
+            except Exception as e:
+                print(f"Skipping the database scenarios: {e}")
+
+    for name, result in results['scenarios'].items():
+        print(f"{name:>20}: {result['seconds'] * 1000:>10.1f} ms  {result['items']:>8} {result['unit']}"
+              f"  ({result['items'] / result['seconds']:,.0f}/s)")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
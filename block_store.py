@@ -0,0 +1,284 @@
+"""Compact, array-backed storage for the measurement blocks parsed from the energy logs."""
+from datetime import datetime
+import numpy as np
+
+
+# Value used for a missing start/end time, the same bit pattern NumPy uses for NaT
+MISSING_TIME = np.iinfo(np.int64).min
+
+MICROSECONDS_PER_DAY = 86_400_000_000
+
+
+class BlockStore:
+    """Measurement blocks held as NumPy columns instead of a list of dicts.
+
+    start_us and end_us are int64 microseconds since the epoch (MISSING_TIME where unknown) and
+    energy is float64, about 24 bytes per block.  Indexing with an int returns the block as the dict
+    process_log_file produces, so existing callers keep working; slices, index arrays and boolean
+    masks return a new BlockStore, and a column name returns the whole column as an array.
+    """
+
+    __slots__ = ('start_us', 'end_us', 'energy')
+
+    def __init__(self, start_us=(), end_us=(), energy=()):
+        self.start_us = np.asarray(start_us, dtype=np.int64)
+        self.end_us = np.asarray(end_us, dtype=np.int64)
+        self.energy = np.asarray(energy, dtype=np.float64)
+        if not len(self.start_us) == len(self.end_us) == len(self.energy):
+            raise ValueError("start_us, end_us and energy must have the same length")
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """Build a store from block dicts with start_time, end_time and total_energy."""
+        blocks = list(blocks)
+        return cls(
+            [_to_us(block['start_time']) for block in blocks],
+            [_to_us(block['end_time']) for block in blocks],
+            [float(block['total_energy']) for block in blocks],
+        )
+
+    @classmethod
+    def concat(cls, stores):
+        """Join several stores end to end."""
+        stores = list(stores)
+        return cls(
+            np.concatenate([store.start_us for store in stores]) if stores else (),
+            np.concatenate([store.end_us for store in stores]) if stores else (),
+            np.concatenate([store.energy for store in stores]) if stores else (),
+        )
+
+    @property
+    def start_time(self):
+        """Block start times as datetime64[us] (NaT where missing)."""
+        return self.start_us.view('M8[us]')
+
+    @property
+    def end_time(self):
+        """Block end times as datetime64[us] (NaT where missing)."""
+        return self.end_us.view('M8[us]')
+
+    @property
+    def duration(self):
+        """Block durations in seconds, computed on demand (NaN where either end is missing)."""
+        missing = (self.start_us == MISSING_TIME) | (self.end_us == MISSING_TIME)
+        return np.where(missing, np.nan, (self.end_us - self.start_us) / 1e6)
+
+    @property
+    def nbytes(self):
+        return self.start_us.nbytes + self.end_us.nbytes + self.energy.nbytes
+
+    def total_energy(self, start=0, stop=None):
+        """Sum the energy of blocks start to stop (exclusive)."""
+        return float(self.energy[start:stop].sum())
+
+    def between(self, start_time, end_time):
+        """Return the blocks that start in [start_time, end_time)."""
+        start_us, end_us = _to_us(start_time), _to_us(end_time)
+        return self[(self.start_us >= start_us) & (self.start_us < end_us)]
+
+    def to_blocks(self):
+        """Convert back to a list of block dicts."""
+        return [self[i] for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.energy)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == 'total_energy':
+                return self.energy
+            if key in ('start_time', 'end_time', 'duration'):
+                return getattr(self, key)
+            raise KeyError(key)
+
+        if isinstance(key, (int, np.integer)):
+            start_time = self.start_time[key].item()
+            end_time = self.end_time[key].item()
+            return {
+                'start_time': start_time,
+                'total_energy': float(self.energy[key]),
+                'end_time': end_time,
+                'duration': (end_time - start_time).total_seconds() if start_time and end_time else None,
+            }
+
+        return BlockStore(self.start_us[key], self.end_us[key], self.energy[key])
+
+    def __repr__(self):
+        return f"BlockStore({len(self)} blocks)"
+
+
+def _to_us(value):
+    """Convert a datetime, datetime64 or None to int64 microseconds since the epoch."""
+    if value is None:
+        return MISSING_TIME
+    if isinstance(value, datetime):
+        value = np.datetime64(value, 'us')
+    return int(np.datetime64(value, 'us').astype(np.int64))
+
+
+class BlockIndex:
+    """Sorted index over the times of day at which blocks start and end, for matching scans to blocks.
+
+    Matches follow merge(): the start block is the first block after the first one whose start is
+    within tolerance minutes of the scan start, and the end block is the first later block whose end
+    is within tolerance minutes of the scan end, comparing times of day only.  Each lookup is a
+    binary search per day covered by the log instead of a pass over every block.
+    """
+
+    def __init__(self, blocks):
+        store = blocks if isinstance(blocks, BlockStore) else BlockStore.from_blocks(blocks)
+        self._starts = _TimeOfDayIndex(store.start_us)
+        self._ends = _TimeOfDayIndex(store.end_us)
+
+    def match(self, start_time, end_time, tolerance):
+        """Return the (start_idx, end_idx) of the blocks covering one scan, or (None, None)."""
+        return self.match_many([start_time], [end_time], tolerance)[0]
+
+    def match_many(self, start_times, end_times, tolerance):
+        """Match many scans in one sweep, returning a (start_idx, end_idx) pair per scan."""
+        starts = self._starts.first_match(_time_of_day_us(start_times), np.ones(len(start_times), np.int64), tolerance)
+        ends = self._ends.first_match(_time_of_day_us(end_times), starts + 1, tolerance)
+        return [
+            (int(start), int(end)) if start >= 0 and end >= 0 else (None, None)
+            for start, end in zip(starts, np.where(starts >= 0, ends, -1))
+        ]
+
+
+class _TimeOfDayIndex:
+    """Times of day of one block column, split into the runs over which they never decrease.
+
+    A log covering several days has one run per day, so each run can be binary searched.  The
+    search key is run * MICROSECONDS_PER_DAY + time of day, which is sorted across all runs.
+    """
+
+    def __init__(self, times_us):
+        valid = times_us != MISSING_TIME
+        self.block_idx = np.flatnonzero(valid)
+        self.time_of_day = np.mod(times_us[valid], MICROSECONDS_PER_DAY)
+
+        new_run = np.ones(len(self.block_idx), dtype=bool)
+        new_run[1:] = (np.diff(self.block_idx) != 1) | (np.diff(self.time_of_day) < 0)
+        run = np.cumsum(new_run) - 1
+        self.run_begin = np.flatnonzero(new_run)
+        self.run_end = np.append(self.run_begin[1:], len(self.block_idx))
+        self.key = run * MICROSECONDS_PER_DAY + self.time_of_day
+
+    def first_match(self, targets_us, min_block_idx, tolerance):
+        """For each target time of day, the first block at or after min_block_idx within tolerance, or -1."""
+        found = np.full(len(targets_us), -1, dtype=np.int64)
+        first_position = np.searchsorted(self.block_idx, min_block_idx)
+        # The integer window is a little wider than the tolerance; the exact test is _within
+        window = int(np.ceil(tolerance * 60e6)) + 1
+
+        for run, (begin, end) in enumerate(zip(self.run_begin, self.run_end)):
+            pending = np.flatnonzero(found < 0)
+            if not len(pending):
+                break
+            offset = run * MICROSECONDS_PER_DAY
+            targets = targets_us[pending]
+            low = np.searchsorted(self.key, offset + targets - window, 'left')
+            low = np.maximum(np.maximum(low, begin), first_position[pending])
+            high = np.minimum(np.searchsorted(self.key, offset + targets + window, 'right'), end)
+
+            for scan, position, stop, target in zip(pending, low, high, targets):
+                # Only the few entries at the edge of the window can fail the exact test
+                while position < stop:
+                    if _within(target, self.time_of_day[position], tolerance):
+                        found[scan] = self.block_idx[position]
+                        break
+                    if self.time_of_day[position] > target:
+                        break
+                    position = np.searchsorted(self.key, self.key[position], 'right')
+
+        return found
+
+
+def _within(target_us, block_us, tolerance):
+    """The diff_mins test: are two times of day less than tolerance minutes apart?"""
+    return abs((target_us - block_us) / 1e6 / 60) < tolerance
+
+
+def _time_of_day_us(times):
+    """Microseconds since midnight of datetime.time or datetime values."""
+    return np.array(
+        [((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000 + t.microsecond for t in times],
+        dtype=np.int64,
+    )
+
+
+class EnergyTimeline:
+    """Every energy sample of a log as a time-sorted series with a running total, for integrating windows.
+
+    time_us holds the sample times (int64 microseconds since the epoch) and energy the energy
+    added at each sample; cumulative[i] is the energy of the first i samples.  The energy of any
+    [start, end) window is then two binary searches and a subtraction.
+    """
+
+    __slots__ = ('time_us', 'energy', 'cumulative')
+
+    def __init__(self, time_us=(), energy=()):
+        time_us = np.asarray(time_us, dtype=np.int64)
+        energy = np.asarray(energy, dtype=np.float64)
+        if len(time_us) != len(energy):
+            raise ValueError("time_us and energy must have the same length")
+
+        order = np.argsort(time_us, kind='stable')
+        self.time_us = time_us[order]
+        self.energy = energy[order]
+        self.cumulative = np.concatenate(([0.0], np.cumsum(self.energy)))
+
+    @classmethod
+    def from_readings(cls, time_us, readings, block_ids):
+        """Build from the cmdUpdateEngInfo readings, which count up from zero within each block.
+
+        Each sample adds its increase over the block's previous reading; the first reading of a
+        block, or one lower than the reading before it, counts in full.
+        """
+        readings = np.asarray(readings, dtype=np.float64)
+        block_ids = np.asarray(block_ids)
+        previous = np.zeros_like(readings)
+        previous[1:] = readings[:-1]
+        same_block = np.zeros(len(readings), dtype=bool)
+        same_block[1:] = block_ids[1:] == block_ids[:-1]
+        continues = same_block & (readings >= previous)
+        return cls(time_us, np.where(continues, readings - previous, readings))
+
+    @classmethod
+    def concat(cls, timelines):
+        """Join several timelines into one."""
+        timelines = list(timelines)
+        return cls(
+            np.concatenate([timeline.time_us for timeline in timelines]) if timelines else (),
+            np.concatenate([timeline.energy for timeline in timelines]) if timelines else (),
+        )
+
+    @property
+    def time(self):
+        """Sample times as datetime64[us]."""
+        return self.time_us.view('M8[us]')
+
+    def integrate(self, start_time, end_time):
+        """Energy of the samples in [start_time, end_time)."""
+        start, end = np.searchsorted(self.time_us, [_to_us(start_time), _to_us(end_time)], 'left')
+        return float(self.cumulative[end] - self.cumulative[start])
+
+    def integrate_many(self, start_times, end_times):
+        """Energy of the samples in each [start, end) window, as an array."""
+        starts = np.searchsorted(self.time_us, _to_us_array(start_times), 'left')
+        ends = np.searchsorted(self.time_us, _to_us_array(end_times), 'left')
+        return self.cumulative[ends] - self.cumulative[starts]
+
+    def __len__(self):
+        return len(self.time_us)
+
+    def __repr__(self):
+        return f"EnergyTimeline({len(self)} samples)"
+
+
+def _to_us_array(values):
+    """Convert datetimes or datetime64 values to an int64 microseconds array."""
+    return np.asarray(values, dtype='M8[us]').astype(np.int64)
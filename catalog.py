@@ -0,0 +1,118 @@
+"""The schema/table/column catalog of the dashboard database, fetched in one query and cached on disk."""
+from storage import CACHE_DIR, atomic_write, database_name
+import json
+import os
+
+
+# Same schemas, tables and ordering as main.get_schemas/get_tables/get_columns, in one round trip
+CATALOG_QUERY = """
+    SELECT n.nspname, c.relname, a.attname, pg_catalog.format_type(a.atttypid, NULL)
+    FROM pg_catalog.pg_namespace n
+    LEFT JOIN pg_catalog.pg_class c
+        ON c.relnamespace = n.oid
+        AND c.relkind IN ('r', 'v', 'f', 'p')
+        AND pg_catalog.has_table_privilege(c.oid, 'SELECT')
+    LEFT JOIN pg_catalog.pg_attribute a
+        ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast', 'public')
+        AND n.nspname NOT LIKE 'pg\\_temp\\_%' AND n.nspname NOT LIKE 'pg\\_toast\\_temp\\_%'
+    ORDER BY n.nspname, c.relname, a.attnum;
+"""
+
+# Every DDL or GRANT touching a schema, table or column rewrites its catalog row and so its xmin
+FINGERPRINT_QUERY = """
+    WITH schemas AS (
+        SELECT n.oid, n.xmin
+        FROM pg_catalog.pg_namespace n
+        WHERE n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast', 'public')
+            AND n.nspname NOT LIKE 'pg\\_temp\\_%' AND n.nspname NOT LIKE 'pg\\_toast\\_temp\\_%'
+    ), relations AS (
+        SELECT c.oid, c.xmin
+        FROM pg_catalog.pg_class c
+        JOIN schemas s ON c.relnamespace = s.oid
+        WHERE c.relkind IN ('r', 'v', 'f', 'p')
+    )
+    SELECT pg_catalog.md5(string_agg(entry, ',' ORDER BY entry))
+    FROM (
+        SELECT 'n' || oid || ':' || xmin::text FROM schemas
+        UNION ALL
+        SELECT 'c' || oid || ':' || xmin::text FROM relations
+        UNION ALL
+        SELECT 'a' || a.attrelid || '.' || a.attnum || ':' || a.xmin::text
+        FROM pg_catalog.pg_attribute a
+        JOIN relations r ON a.attrelid = r.oid
+        WHERE a.attnum > 0
+    ) AS catalog(entry);
+"""
+
+# Column types that summaries take the sum and average of (as named by format_type)
+NUMERIC_TYPES = {'smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision'}
+
+DEFAULT_CACHE_PATH = os.path.join(CACHE_DIR, 'catalog.json')
+
+
+def load_catalog(conn, cache_path=None, refresh=False):
+    """Return (schemas, info) as main.py uses them, from the disk cache while the catalog is unchanged.
+
+    info is a list of {schema: {table: [(column, data_type), ...]}} in schema order.  One small
+    fingerprint query decides whether the cache is still valid; otherwise the whole catalog is read
+    with CATALOG_QUERY and the cache rewritten.
+    """
+    cache_path = cache_path or os.environ.get('MRI_CATALOG_CACHE', DEFAULT_CACHE_PATH)
+    database = database_name()
+
+    with conn.cursor() as cur:
+        cur.execute(FINGERPRINT_QUERY)
+        fingerprint = cur.fetchone()[0]
+
+        cached = None if refresh else _read_cache(cache_path)
+        if cached and cached['database'] == database and cached['fingerprint'] == fingerprint:
+            schemas, info = cached['schemas'], cached['info']
+        else:
+            cur.execute(CATALOG_QUERY)
+            schemas, info = _build_catalog(cur.fetchall())
+            _write_cache(cache_path, {'database': database, 'fingerprint': fingerprint,
+                                      'schemas': schemas, 'info': info})
+
+    conn.rollback()
+    return schemas, [
+        {schema: {table: [tuple(column) for column in columns] for table, columns in tables.items()}}
+        for entry in info for schema, tables in entry.items()
+    ]
+
+
+def numeric_columns(info, schema, table):
+    """The columns of schema.table in info (as load_catalog returns it) with a numeric type."""
+    for entry in info:
+        if schema in entry:
+            return [column for column, data_type in entry[schema].get(table, []) if data_type in NUMERIC_TYPES]
+    return []
+
+
+def _build_catalog(rows):
+    """Group (schema, table, column, data_type) rows into the schemas list and info structure."""
+    catalog = {}
+    for schema, table, column, data_type in rows:
+        tables = catalog.setdefault(schema, {})
+        if table is not None:
+            columns = tables.setdefault(table, [])
+            if column is not None:
+                columns.append((column, data_type))
+    return list(catalog), [{schema: tables} for schema, tables in catalog.items()]
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(cache_path, cache):
+    """Write the cache atomically so a concurrent reader never sees half a file."""
+    try:
+        with atomic_write(cache_path) as file:
+            json.dump(cache, file)
+    except OSError as e:
+        print(f"Could not write the catalog cache: {e}")
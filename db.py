@@ -0,0 +1,130 @@
+"""Shared, pooled access to the MRI dashboard database.
+
+Settings come from a JSON file (MRI_DB_CONFIG, or db_config.json next to this file) and are then
+overridden by MRI_DB_* environment variables, e.g.:
+
+    {"host": "localhost", "port": 5432, "dbname": "mriutilisation", "user": "mridevs",
+     "password": "...", "pool_min": 1, "pool_max": 10}
+"""
+from contextlib import contextmanager
+from psycopg2 import extensions, pool
+import threading
+import psycopg2
+import json
+import time
+import os
+
+
+DEFAULT_CONFIG = {
+    'dbname': 'mriutilisation',
+    'user': 'mridevs',
+    'password': 'qwer1234',
+    'host': 'localhost',
+    'port': 5432,
+    'pool_min': 1,
+    'pool_max': 10,
+    'health_check_interval': 30,
+}
+
+# Environment variable for each setting
+ENV_VARS = {
+    'dbname': 'MRI_DB_NAME',
+    'user': 'MRI_DB_USER',
+    'password': 'MRI_DB_PASSWORD',
+    'host': 'MRI_DB_HOST',
+    'port': 'MRI_DB_PORT',
+    'pool_min': 'MRI_DB_POOL_MIN',
+    'pool_max': 'MRI_DB_POOL_MAX',
+    'health_check_interval': 'MRI_DB_HEALTH_CHECK_INTERVAL',
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+_health_check_interval = DEFAULT_CONFIG['health_check_interval']
+_last_used = {}
+
+
+def load_config(config_path=None):
+    """Return the database settings: defaults, then the config file, then the environment."""
+    config = dict(DEFAULT_CONFIG)
+
+    config_path = config_path or os.environ.get('MRI_DB_CONFIG') or \
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_config.json')
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as file:
+            config.update(json.load(file))
+
+    for key, env_var in ENV_VARS.items():
+        if env_var in os.environ:
+            config[key] = os.environ[env_var]
+
+    for key in ('port', 'pool_min', 'pool_max'):
+        config[key] = int(config[key])
+    config['health_check_interval'] = float(config['health_check_interval'])
+    return config
+
+
+def db_params(config=None):
+    """The psycopg2.connect keyword arguments from the settings."""
+    config = config or load_config()
+    return {key: config[key] for key in ('dbname', 'user', 'password', 'host', 'port')}
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool, _health_check_interval
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            config = load_config()
+            _pool = pool.ThreadedConnectionPool(config['pool_min'], config['pool_max'], **db_params(config))
+            _health_check_interval = config['health_check_interval']
+        return _pool
+
+
+def close_pool():
+    """Close every pooled connection."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+        _last_used.clear()
+
+
+@contextmanager
+def get_connection():
+    """Borrow a connection from the pool for the duration of a with block.
+
+    A connection idle for longer than the health check interval is tested with SELECT 1 and
+    replaced if the server has dropped it.  Any transaction left open is rolled back when the
+    connection goes back to the pool.
+    """
+    connection_pool = get_pool()
+    conn = connection_pool.getconn()
+    if time.monotonic() - _last_used.get(id(conn), 0) > _health_check_interval and not _is_healthy(conn):
+        connection_pool.putconn(conn, close=True)
+        conn = connection_pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        if conn.closed:
+            connection_pool.putconn(conn, close=True)
+        else:
+            if conn.status != extensions.STATUS_READY:
+                conn.rollback()
+            _last_used[id(conn)] = time.monotonic()
+            connection_pool.putconn(conn)
+
+
+def _is_healthy(conn):
+    """Check that a pooled connection still reaches the server."""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
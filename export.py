@@ -0,0 +1,316 @@
+"""Writers that stream query results to disk a batch of rows at a time, so memory stays bounded."""
+from openpyxl import Workbook
+from datetime import datetime, timedelta, date, time
+from decimal import Decimal, localcontext
+import numpy as np
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet/Arrow output is optional
+    pa = pq = None
+
+
+def output_format(file_path, fmt=None):
+    """Return the output format, taken from fmt if given, otherwise from the file extension."""
+    fmt = (fmt or os.path.splitext(file_path)[1].lstrip('.') or 'xlsx').lower()
+    if fmt not in WRITERS:
+        raise ValueError(f"Unsupported output format '{fmt}', choose from {', '.join(WRITERS)}")
+    return fmt
+
+
+def write_batches(file_path, column_names, batches, fmt=None, type_codes=None):
+    """Write an iterable of row batches to file_path and return the number of rows written.
+
+    type_codes are the PostgreSQL type OIDs of the columns (cursor.description), which the
+    columnar formats use to fix their schema before the first batch.
+    """
+    writer = WRITERS[output_format(file_path, fmt)]
+    if writer in (write_parquet, write_arrow):
+        return writer(file_path, column_names, batches, type_codes)
+    return writer(file_path, column_names, batches)
+
+
+def copy_csv(cursor, query, params, file_path):
+    """Write the result of query to a CSV file with COPY ... TO STDOUT, so rows never become Python objects."""
+    query = cursor.mogrify(query, params).decode().strip().rstrip(';')
+    with open(file_path, 'w', newline='') as file:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", file)
+    return cursor.rowcount
+
+
+# Excel's row limit per sheet, including the header row
+XLSX_MAX_ROWS = 1048576
+
+
+def write_xlsx(file_path, column_names, batches):
+    """Write rows through openpyxl's write-only workbook, which streams them to the file.
+
+    Results longer than Excel's row limit continue on Sheet2, Sheet3, ... each with the header.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = XLSX_MAX_ROWS
+
+    rows = 0
+    for batch in batches:
+        for row in batch:
+            if sheet_rows == XLSX_MAX_ROWS:
+                sheet = workbook.create_sheet(f"Sheet{len(workbook.worksheets) + 1}")
+                sheet.append(column_names)
+                sheet_rows = 1
+            # Times are written as text, as pandas' to_excel wrote them
+            sheet.append([str(value) if isinstance(value, time) else value for value in row])
+            sheet_rows += 1
+        rows += len(batch)
+
+    if sheet is None:
+        workbook.create_sheet('Sheet1').append(column_names)
+    workbook.save(file_path)
+    return rows
+
+
+def write_csv(file_path, column_names, batches):
+    """Write rows to a CSV file with a header line, byte for byte as copy_csv's COPY ... CSV writes them."""
+    rows = 0
+    with open(file_path, 'w', newline='') as file:
+        file.write(",".join(_csv_field(name) for name in column_names) + "\n")
+        for batch in batches:
+            file.writelines(",".join(_csv_field(_copy_text(value)) for value in row) + "\n" for row in batch)
+            rows += len(batch)
+    return rows
+
+
+def _csv_field(text):
+    # COPY quotes only what needs it, and an empty string so that it differs from NULL
+    if text is None:
+        return ''
+    if text == '' or any(c in text for c in ',"\n\r'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _copy_text(value):
+    """A value as PostgreSQL prints it (DateStyle ISO, IntervalStyle postgres), or None for NULL."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (bool, np.bool_)):
+        return 't' if value else 'f'
+    if isinstance(value, np.float32):
+        return _float_text(value, 6)
+    if isinstance(value, (float, np.floating)):
+        return _float_text(np.float64(value), 15)
+    if isinstance(value, datetime):
+        text = f"{value:%Y-%m-%d %H:%M:%S}{_fraction(value.microsecond)}"
+        offset = value.utcoffset()
+        if offset is not None:
+            seconds = int(offset.total_seconds())
+            sign, seconds = ('-' if seconds < 0 else '+'), abs(seconds)
+            text += f"{sign}{seconds // 3600:02d}" + (f":{seconds % 3600 // 60:02d}" if seconds % 3600 else '')
+        return text
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, time):
+        return f"{value:%H:%M:%S}{_fraction(value.microsecond)}"
+    if isinstance(value, timedelta):
+        return _interval_text(value)
+    if isinstance(value, Decimal):
+        return str(value)
+    return str(value)
+
+
+def _fraction(microseconds):
+    # Fractional seconds without trailing zeros, none at all for whole seconds
+    return f".{microseconds:06d}".rstrip('0') if microseconds else ''
+
+
+def _float_text(value, digits):
+    """The shortest text that reads back as value, laid out as float4out/float8out lay it out.
+
+    PostgreSQL switches to an exponent below 1e-4 and from 10**digits (15 for double precision,
+    6 for real), where Python's repr would switch at 1e16 and print 1.0 for 1.
+    """
+    if np.isnan(value):
+        return 'NaN'
+    if np.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    mantissa, exponent = _shortest_digits(value).split('e')
+    exponent = int(exponent)
+    sign = '-' if mantissa.startswith('-') else ''
+    mantissa_digits = mantissa.lstrip('-').replace('.', '')
+    if mantissa_digits == '0':
+        return sign + '0'
+    if exponent < -4 or exponent >= digits:
+        rest = mantissa_digits[1:]
+        return f"{sign}{mantissa_digits[0]}{'.' + rest if rest else ''}e{'-' if exponent < 0 else '+'}{abs(exponent):02d}"
+    if exponent < 0:
+        return f"{sign}0.{'0' * (-exponent - 1)}{mantissa_digits}"
+    whole, fraction = mantissa_digits[:exponent + 1], mantissa_digits[exponent + 1:]
+    return f"{sign}{whole.ljust(exponent + 1, '0')}{'.' + fraction if fraction else ''}"
+
+
+def _shortest_digits(value):
+    """value in scientific notation with the fewest digits PostgreSQL's shortest-output code prints.
+
+    Unlike Python and NumPy, it never picks digits lying exactly halfway to the next float (it
+    prints 1e23 as 9.999999999999999e+22), so such a value gets more digits until it is not.
+    """
+    text = np.format_float_scientific(value, unique=True, trim='-')
+    precision = len(text.split('e')[0].lstrip('-').replace('.', '')) - 1
+    with localcontext() as context:
+        context.prec = 1000  # exact for any float
+        exact = Decimal(float(value))
+        while True:
+            candidate = Decimal(text)
+            if candidate == exact or abs(value) == np.finfo(value.dtype).max:
+                return text
+            neighbour = np.nextafter(value, np.inf if candidate > exact else -np.inf)
+            if candidate != (exact + Decimal(float(neighbour))) / 2:
+                return text
+            precision += 1
+            text = np.format_float_scientific(value, unique=False, precision=precision, trim='-')
+
+
+def _interval_text(value):
+    days, seconds, microseconds = value.days, value.seconds, value.microseconds
+    if days < 0 and (seconds or microseconds):
+        # timedelta keeps a negative day count with a positive time; PostgreSQL shows e.g. -00:00:01
+        days, total = days + 1, 86400 * 1_000_000 - (seconds * 1_000_000 + microseconds)
+        seconds, microseconds = divmod(total, 1_000_000)
+        time_sign = '-'
+    else:
+        time_sign = ''
+    parts = [f"{days} day{'' if days == 1 else 's'}"] if days else []
+    if seconds or microseconds or not days:
+        parts.append(f"{time_sign}{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}{_fraction(microseconds)}")
+    return " ".join(parts)
+
+
+# PostgreSQL type OIDs and the Arrow types their values are stored as
+ARROW_TYPES = {
+    16: 'bool_',
+    20: 'int64', 21: 'int16', 23: 'int32',
+    700: 'float32', 701: 'float64', 1700: 'float64',
+    18: 'string', 19: 'string', 25: 'string', 1042: 'string', 1043: 'string',
+    1082: 'date32',
+}
+
+
+def arrow_schema(column_names, type_codes, first_batch):
+    """Build the Arrow schema from the column type OIDs, inferring from the first batch otherwise."""
+    fields = []
+    for i, name in enumerate(column_names):
+        code = type_codes[i] if type_codes else None
+        if code in ARROW_TYPES:
+            arrow_type = getattr(pa, ARROW_TYPES[code])()
+        elif code == 1083:
+            arrow_type = pa.time64('us')
+        elif code == 1114:
+            arrow_type = pa.timestamp('us')
+        elif code == 1184:
+            arrow_type = pa.timestamp('us', tz='UTC')
+        elif code == 1186:
+            arrow_type = pa.duration('us')
+        else:
+            arrow_type = pa.array([row[i] for row in first_batch]).type
+            if pa.types.is_null(arrow_type):
+                arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def _record_batches(column_names, batches, type_codes):
+    """Yield the Arrow schema, then one RecordBatch per batch of rows."""
+    _require_pyarrow()
+
+    schema = None
+    for batch in batches:
+        if schema is None:
+            schema = arrow_schema(column_names, type_codes, batch)
+            yield schema
+        columns = list(zip(*batch)) or [[] for _ in column_names]
+        arrays = []
+        for values, field in zip(columns, schema):
+            if pa.types.is_floating(field.type):
+                values = [None if value is None else float(value) for value in values]
+            elif pa.types.is_string(field.type):
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    if schema is None:
+        yield arrow_schema(column_names, type_codes, [])
+
+
+def _require_pyarrow():
+    if pa is None or pq is None:
+        raise RuntimeError("Parquet and Arrow output need pyarrow (pip3 install pyarrow)")
+
+
+def to_arrow_table(column_names, batches, type_codes=None):
+    """Collect row batches into one Arrow table, typed as write_parquet would type them."""
+    record_batches = _record_batches(column_names, batches, type_codes)
+    schema = next(record_batches)
+    return pa.Table.from_batches(list(record_batches), schema=schema)
+
+
+def write_table(file_path, table, fmt=None, batch_size=5000):
+    """Write an Arrow table in any output format and return the number of rows written."""
+    _require_pyarrow()
+    fmt = output_format(file_path, fmt)
+    if fmt == 'parquet':
+        pq.write_table(table, file_path)
+    elif WRITERS[fmt] is write_arrow:
+        with pa.OSFile(file_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        batches = (
+            list(zip(*[_column_values(column, fmt) for column in record_batch.columns]))
+            for record_batch in table.to_batches(max_chunksize=batch_size)
+        )
+        WRITERS[fmt](file_path, table.column_names, batches)
+    return table.num_rows
+
+
+def _column_values(column, fmt):
+    values = column.to_pylist()
+    if fmt == 'csv' and pa.types.is_float32(column.type):
+        # Kept as float32 so the CSV prints them with real's precision, as COPY does
+        values = [None if value is None else np.float32(value) for value in values]
+    return values
+
+
+def write_parquet(file_path, column_names, batches, type_codes=None):
+    """Write rows to a Parquet file, one row group per batch."""
+    _require_pyarrow()
+    record_batches = _record_batches(column_names, batches, type_codes)
+    rows = 0
+    with pq.ParquetWriter(file_path, next(record_batches)) as writer:
+        for record_batch in record_batches:
+            writer.write_batch(record_batch)
+            rows += record_batch.num_rows
+    return rows
+
+
+def write_arrow(file_path, column_names, batches, type_codes=None):
+    """Write rows to an Arrow IPC (Feather v2) file, one record batch per batch."""
+    _require_pyarrow()
+    record_batches = _record_batches(column_names, batches, type_codes)
+    rows = 0
+    with pa.OSFile(file_path, 'wb') as sink:
+        schema = next(record_batches)
+        with pa.ipc.new_file(sink, schema) as writer:
+            for record_batch in record_batches:
+                writer.write_batch(record_batch)
+                rows += record_batch.num_rows
+    return rows
+
+
+WRITERS = {
+    'xlsx': write_xlsx,
+    'csv': write_csv,
+    'parquet': write_parquet,
+    'arrow': write_arrow,
+    'feather': write_arrow,
+}
@@ -1,81 +1,311 @@
 from datetime import datetime, timedelta
+from psycopg2 import sql
+from db import get_connection
+from log_index import MTIME_RESOLUTION_NS
+from storage import CACHE_DIR, atomic_write
+from main import get_schemas
+from notification_feed import write_notifications
+import threading
+import argparse
 import json
+import time
 import os
+import re
 
 app_path = "/Users/oscarlally/Desktop/Oscar/PhysicsDashboard/tailwind-dashboard-template-main/public"
 base_paths = ['/Users/oscarlally/Desktop/try/GMRI3', '/Users/oscarlally/Desktop/try/GMRI4', '/Users/oscarlally/Desktop/try/SMRVID']
 
-# Get the date a week ago
 scanner_list = ["EMRI1", "EXMRI", "SMRVID", "GMRI3", "GMRI4"]
-current_datetime = datetime.now()
-
-# Generate a list of all days from yesterday to a week ago
-days_list = []
-for i in range(7):
-    day = current_datetime - timedelta(days=i+1)  # Subtract i+1 days from current date
-    formatted_day = day.strftime("%d-%m-%y")
-    days_list.append(formatted_day)
-
-messages = []
-
-for i in base_paths:
-    file_names = [f for f in os.listdir(i) if not f.startswith('.')]
-    full_file_names = [os.path.join(i, file) for file in file_names]
-    all_files = "".join(full_file_names)
-    if not any(day in all_files for day in days_list):
-        for j in scanner_list:
-            if j in all_files:
+
+# The last-seen index of each base path, kept between runs
+DEFAULT_INDEX_PATH = os.path.join(CACHE_DIR, 'inactivity_index.json')
+
+# Seconds to wait for all the base paths to be scanned; a path that takes longer is unreachable
+SCAN_TIMEOUT = 30
+
+# Every dd-mm-yy looking run of characters in a file name, overlapping ones included
+DATE_PATTERN = re.compile(r"(?=(\d\d-\d\d-\d\d))")
+
+
+def recent_days(current_datetime, days=7):
+    """The dd-mm-yy dates of every day from yesterday to a week ago."""
+    days_list = []
+    for i in range(days):
+        day = current_datetime - timedelta(days=i+1)  # Subtract i+1 days from current date
+        days_list.append(day.strftime("%d-%m-%y"))
+    return days_list
+
+
+def load_index(index_path=None):
+    try:
+        with open(index_path or os.environ.get('MRI_INACTIVITY_INDEX', DEFAULT_INDEX_PATH), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index, index_path=None):
+    """Write the index atomically so an interrupted run never leaves half a file."""
+    index_path = index_path or os.environ.get('MRI_INACTIVITY_INDEX', DEFAULT_INDEX_PATH)
+    try:
+        with atomic_write(index_path) as file:
+            json.dump(index, file)
+    except OSError as e:
+        print(f"Could not write the inactivity index: {e}")
+
+
+def scan_base_path(base_path, entry=None):
+    """Bring the index entry of one base path up to date and return it.
+
+    The entry records, for every file name, the dd-mm-yy dates and scanner names it contains and its
+    mtime, and for the base path as a whole the dates and scanners found and when each scanner was
+    last seen.  The directory is only listed again when its mtime has changed, and only file names
+    not seen before are examined.
+    """
+    entry = entry or {'mtime_ns': None, 'names': {}}
+    mtime_ns = os.stat(base_path).st_mtime_ns
+    if entry['mtime_ns'] == mtime_ns:
+        return entry
+
+    known = entry['names']
+    names = {}
+    with os.scandir(base_path) as entries:
+        for dir_entry in entries:
+            if dir_entry.name.startswith('.'):
+                continue
+            if dir_entry.name in known:
+                names[dir_entry.name] = known[dir_entry.name]
+                continue
+            names[dir_entry.name] = {
+                'dates': sorted(set(DATE_PATTERN.findall(os.path.join(base_path, dir_entry.name)))),
+                'scanners': [j for j in scanner_list if j in dir_entry.name],
+                'mtime': dir_entry.stat().st_mtime,
+            }
+
+    # A file added within the filesystem's mtime resolution of now would not change the mtime again
+    if time.time_ns() - mtime_ns < MTIME_RESOLUTION_NS:
+        mtime_ns = None
+
+    # What the joined string of full file names contained; an empty directory contains nothing
+    dates, scanners = set(), []
+    if names:
+        dates = set(DATE_PATTERN.findall(base_path)).union(*(name['dates'] for name in names.values()))
+        found = set().union(*(name['scanners'] for name in names.values()))
+        scanners = [j for j in scanner_list if j in base_path or j in found]
+
+    return {
+        'mtime_ns': mtime_ns,
+        'names': names,
+        'dates': sorted(dates),
+        'scanners': scanners,
+        'last_seen': last_seen(base_path, names),
+    }
+
+
+def scan_base_paths(base_paths, index, timeout=SCAN_TIMEOUT):
+    """Scan all the base paths at once and return (entries, unreachable paths) within timeout seconds.
+
+    Each path is scanned on its own daemon thread, so a hung network mount neither delays the other
+    scanners past the timeout nor keeps the program from exiting.  A path that has not answered by
+    then, or that raised an OSError, is unreachable and keeps its entry from the last run.
+    """
+    results = {}
+
+    def scan(base_path):
+        try:
+            results[base_path] = scan_base_path(base_path, index.get(base_path))
+        except OSError as e:
+            results[base_path] = e
+
+    threads = [threading.Thread(target=scan, args=(i,), name=f"scan {i}", daemon=True) for i in base_paths]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    entries, unreachable = {}, []
+    for i in base_paths:
+        result = results.get(i)
+        if isinstance(result, dict):
+            entries[i] = result
+        else:
+            print(f"{i} is unreachable: {result or f'no answer within {timeout}s'}")
+            unreachable.append(i)
+    return entries, unreachable
+
+
+def unreachable_scanners(unreachable, index):
+    """The scanners behind unreachable base paths, as found on the last run or named in the path."""
+    names = []
+    for i in unreachable:
+        scanners = index.get(i, {}).get('scanners') or [j for j in scanner_list if j in i] or [i]
+        names.extend(j for j in scanners if j not in names)
+    return names
+
+
+def last_seen(base_path, names):
+    """The latest file date and modification time of each scanner under a base path."""
+    seen = {}
+    for j in scanner_list:
+        matching = list(names.values()) if j in base_path else [name for name in names.values() if j in name['scanners']]
+        if not matching:
+            continue
+        dates = []
+        for day in set().union(*(name['dates'] for name in matching)):
+            try:
+                dates.append(datetime.strptime(day, "%d-%m-%y").date())
+            except ValueError:
+                pass  # e.g. 45-13-99 in a serial number
+        seen[j] = {
+            'last_date': max(dates).isoformat() if dates else None,
+            'last_modified': datetime.fromtimestamp(max(name['mtime'] for name in matching)).isoformat(),
+        }
+    return seen
+
+
+def offline_scanners(entries, days_list):
+    """The scanners under each base path that has no file dated in days_list, in base path order.
+
+    A base path counts as a match for a date or scanner name that appears in it or in any of its
+    file names, as the joined string of full file names did.
+    """
+    messages = []
+    for entry in entries.values():
+        dates = set(entry['dates'])
+        if not any(day in dates for day in days_list):
+            for j in entry['scanners']:
                 messages.append(f"{j}")
+    return messages
+
+
+def database_activity(cursor, schemas, start_date, end_date):
+    """The latest date, and the latest date in [start_date, end_date], of each schema's dates table.
+
+    All the schemas are read with one UNION ALL query, returning {schema: (latest, latest recent)}.
+    """
+    if not schemas:
+        return {}  # an empty UNION ALL is not a query
+    query = sql.SQL(" UNION ALL ").join(
+        sql.SQL("SELECT {name}, max(d.date), max(d.date) FILTER (WHERE d.date BETWEEN %(start)s AND %(end)s) "
+                "FROM {schema}.dates d").format(name=sql.Literal(schema), schema=sql.Identifier(schema))
+        for schema in schemas
+    )
+    cursor.execute(query, {'start': start_date, 'end': end_date})
+    return {schema: (latest, recent) for schema, latest, recent in cursor.fetchall()}
 
 
-# Create the new dictionary entry
-message = ""
-for idx, i in enumerate(messages):
-    if idx == 0:
-        message = message + i
-    if 0 < idx < len(messages) - 1:
-        message = message + ', ' + i
-    if idx == len(messages) - 1 and idx != 0:
-        message = message + ' and ' + i
-
-if len(messages) == 1:
-    message = 'CRITICAL: ' + message + ' is offline and inactive. Please rectify immediately.'
-    icon = '🚨'
-elif len(messages) > 1:
-    message = 'CRITICAL: ' + message + ' are offline and inactive. Please rectify immediately.'
-    icon = '🚨'
-else:
-    message = "All scanners are regularly updating!"
-    icon = '🔔'
-
-
-# Save the new data in a dictionary
-new_data = {
+def offline_scanners_from_database(current_datetime):
+    """The scanners whose schema has no date from yesterday to a week ago, as offline_scanners decides from files."""
+    today = current_datetime.date()
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            schemas = {schema.upper(): schema for schema in get_schemas(cursor)}
+            scanners = [j for j in scanner_list if j in schemas]
+            activity = database_activity(cursor, [schemas[j] for j in scanners],
+                                         today - timedelta(days=7), today - timedelta(days=1))
+
+    messages = []
+    for j in scanners:
+        latest, recent = activity[schemas[j]]
+        print(f"{j}: last date in the database {latest}")
+        if recent is None:
+            messages.append(f"{j}")
+    return messages
+
+
+def join_names(names):
+    """'A', 'A and B', 'A, B and C'."""
+    message = ""
+    for idx, i in enumerate(names):
+        if idx == 0:
+            message = message + i
+        if 0 < idx < len(names) - 1:
+            message = message + ', ' + i
+        if idx == len(names) - 1 and idx != 0:
+            message = message + ' and ' + i
+    return message
+
+
+def build_notification(messages, current_datetime, unreachable=()):
+    """The notifications.json entry for the offline scanners, and the scanners that could not be reached."""
+    # Create the new dictionary entry
+    message = join_names(messages)
+
+    if len(messages) == 1:
+        message = 'CRITICAL: ' + message + ' is offline and inactive. Please rectify immediately.'
+        icon = '🚨'
+    elif len(messages) > 1:
+        message = 'CRITICAL: ' + message + ' are offline and inactive. Please rectify immediately.'
+        icon = '🚨'
+    elif not unreachable:
+        message = "All scanners are regularly updating!"
+        icon = '🔔'
+    else:
+        message = ""
+        icon = '⚠️'
+
+    if unreachable:
+        verb = 'is' if len(unreachable) == 1 else 'are'
+        warning = f"WARNING: {join_names(unreachable)} {verb} unreachable on the shared drive. Please check the connection."
+        message = f"{message} {warning}" if message else warning
+
+    # Save the new data in a dictionary
+    return {
         "icon": icon,
         "message": f"{message}",
         "date": current_datetime.strftime("%b %d, %Y"),
         "link": "#0"
-        }
-
-
-# Read the existing JSON data
-with open(f"{app_path}/notifications.json", 'r') as file:
-    data = json.load(file)
+    }
 
-# Replace the first item
-data[0] = new_data
 
-# Write the updated data back to the JSON file
-with open(f"{app_path}/notifications.json", 'w') as file:
-    json.dump(data, file, indent=2)
+def write_notification(new_data, notifications_path):
+    """Replace the first notification in notifications.json, atomically and with a new version."""
+    # Read the existing JSON data
+    with open(notifications_path, 'r') as file:
+        data = json.load(file)
 
+    # Replace the first item
+    data[0] = new_data
 
+    # Write the updated data back to the JSON file
+    write_notifications(data, notifications_path)
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Update the scanner inactivity notification on the dashboard.")
+    parser.add_argument('--source', choices=['files', 'db'], default='files',
+                        help="check the files on the shared drive (default), or the dates ingested into the database")
+    parser.add_argument('--timeout', type=float, default=SCAN_TIMEOUT,
+                        help=f"seconds to wait for the shared drive before calling a scanner unreachable (default {SCAN_TIMEOUT})")
+    args = parser.parse_args()
 
+    current_datetime = datetime.now()
 
+    # The database knows the latest ingested date of every scanner without touching the shared drive
+    if args.source == 'db':
+        try:
+            messages = offline_scanners_from_database(current_datetime)
+        except Exception as e:
+            print(f"Error: {e}")
+            return
+        write_notification(build_notification(messages, current_datetime), f"{app_path}/notifications.json")
+        return
 
+    days_list = recent_days(current_datetime)
+    index = load_index()
+    entries, unreachable = scan_base_paths(base_paths, index, args.timeout)
+    index.update(entries)
+    save_index(index)
 
+    for entry in entries.values():
+        for j, seen in entry['last_seen'].items():
+            print(f"{j}: last file dated {seen['last_date']}, last modified {seen['last_modified']}")
 
+    messages = offline_scanners(entries, days_list)
+    new_data = build_notification(messages, current_datetime, unreachable_scanners(unreachable, index))
+    write_notification(new_data, f"{app_path}/notifications.json")
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""A persistent per-directory index of the energy logs, for stitching blocks that run across files.
+
+For each log file the index keeps what complete_block_from_adjacent_files needs: the timestamp of
+its second and last lines, the energy updates and end line that continue a block from the file
+before, and whether the file ends with a block still open.  Each is read from the head or tail of
+the file only, the first time it is asked for, and kept until the file's size or mtime changes.
+The sorted list of log files is kept too, and only relisted when the directory's mtime changes.
+
+Timestamps are stored as the raw text before the first '|', for power_log_merge to parse.
+Logs compressed with gzip (.txt.gz) or zstd (.txt.zst) are listed and read like plain ones.
+"""
+from itertools import islice
+from storage import CACHE_DIR, atomic_write, path_cache_file
+import threading
+import atexit
+import gzip
+import json
+import time
+import io
+import os
+
+try:
+    import zstandard
+except ImportError:  # .zst logs are optional
+    zstandard = None
+
+
+# Compressed logs are decompressed as they are read, never unpacked to disk
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+DEFAULT_INDEX_DIR = os.path.join(CACHE_DIR, 'log_index')
+
+INDEX_VERSION = 1
+
+# Network shares can keep directory mtimes to the nearest 2 seconds
+MTIME_RESOLUTION_NS = 2_000_000_000
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class LogIndex:
+    """The index of one directory of logs, loaded from and saved to a JSON file."""
+
+    def __init__(self, directory, index_path=None):
+        self.directory = directory
+        self.index_path = index_path or default_index_path(directory)
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._data = _read_index(self.index_path, os.path.abspath(directory))
+
+    def files(self):
+        """The .txt logs of the directory, compressed or not, sorted by name."""
+        with self._lock:
+            mtime_ns = os.stat(self.directory or '.').st_mtime_ns
+            if self._data['mtime_ns'] != mtime_ns:
+                files = sorted([f for f in os.listdir(self.directory or '.') if is_log_file(f)])
+
+                # A file added within the filesystem's mtime resolution of now would not change the mtime again
+                if _recent(mtime_ns):
+                    mtime_ns = None
+
+                entries = self._data['entries']
+                self._data.update(mtime_ns=mtime_ns, files=files,
+                                  entries={name: entries[name] for name in files if name in entries})
+                self._dirty = True
+            return self._data['files']
+
+    def neighbours(self, file_path):
+        """The paths of the files sorted just before and after file_path (None at either end)."""
+        files = self.files()
+        current_file_index = files.index(os.path.basename(file_path))
+        previous_file_path = os.path.join(self.directory, files[current_file_index - 1]) if current_file_index > 0 else None
+        next_file_path = os.path.join(self.directory, files[current_file_index + 1]) if current_file_index < len(files) - 1 else None
+        return previous_file_path, next_file_path
+
+    def second_stamp(self, file_path):
+        """Raw timestamp of the first line after the first one that has a '|', or None."""
+        return self._get(file_path, 'second', read_second_stamp)
+
+    def last_stamp(self, file_path):
+        """Raw timestamp of the last line that has a '|', or None."""
+        return self._get(file_path, 'last', read_last_stamp)
+
+    def head(self, file_path):
+        """(energies, end stamp) of the updates and end line that continue a block into the file.
+
+        A file modified within MTIME_RESOLUTION_NS of now may still be growing without its size or
+        mtime changing again, so its head is read each time instead of being kept.
+        """
+        with self._lock:
+            entry = self._entry(file_path)
+            if _recent(entry['mtime_ns']):
+                entry.pop('head', None)
+                return read_head(os.path.join(self.directory, os.path.basename(file_path)))
+        energies, end_stamp = self._get(file_path, 'head', lambda path: list(read_head(path)))
+        return energies, end_stamp
+
+    def open_block(self, file_path):
+        """Whether the file ends with an open block, or None if it has not been parsed since it changed."""
+        return self._get(file_path, 'open_block', lambda path: None)
+
+    def set_open_block(self, file_path, is_open):
+        is_open = bool(is_open)  # a NumPy bool would not be JSON serializable
+        with self._lock:
+            entry = self._entry(file_path)
+            if entry.get('open_block') != is_open:
+                entry['open_block'] = is_open
+                self._dirty = True
+
+    def save(self):
+        """Write the index if anything changed, atomically so a concurrent reader never sees half a file."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                with atomic_write(self.index_path) as file:
+                    json.dump(self._data, file)
+                self._dirty = False
+            except (OSError, TypeError, ValueError) as e:
+                print(f"Could not write the log index: {e}")
+
+    def _entry(self, file_path):
+        """The entry of a file, emptied if the file has changed since it was indexed."""
+        name = os.path.basename(file_path)
+        stat = os.stat(os.path.join(self.directory, name))
+        entry = self._data['entries'].get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = self._data['entries'][name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            self._dirty = True
+        return entry
+
+    def _get(self, file_path, key, read):
+        with self._lock:
+            entry = self._entry(file_path)
+            if key not in entry:
+                entry[key] = read(os.path.join(self.directory, os.path.basename(file_path)))
+                self._dirty = True
+            return entry[key]
+
+
+def get_log_index(directory):
+    """The shared LogIndex of a directory, saved when the interpreter exits."""
+    key = os.path.abspath(directory)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = LogIndex(directory)
+        return _indexes[key]
+
+
+@atexit.register
+def save_log_indexes():
+    """Save every shared index that has changed."""
+    with _indexes_lock:
+        for index in _indexes.values():
+            index.save()
+
+
+def recently_modified(file_path):
+    """Whether a file changed within MTIME_RESOLUTION_NS of now, and so may still be being written."""
+    return _recent(os.stat(file_path).st_mtime_ns)
+
+
+def _recent(mtime_ns):
+    return time.time_ns() - mtime_ns < MTIME_RESOLUTION_NS
+
+
+def default_index_path(directory):
+    """Where the index of a directory is kept: MRI_LOG_INDEX_DIR, or ~/.cache/mri_dashboard/log_index."""
+    return path_cache_file(os.environ.get('MRI_LOG_INDEX_DIR', DEFAULT_INDEX_DIR), directory)
+
+
+def _read_index(index_path, directory):
+    try:
+        with open(index_path, 'r') as file:
+            data = json.load(file)
+        if data.get('version') == INDEX_VERSION and data.get('directory') == directory:
+            return data
+    except (OSError, ValueError):
+        pass
+    return {'version': INDEX_VERSION, 'directory': directory, 'mtime_ns': None, 'files': [], 'entries': {}}
+
+
+def is_log_file(name):
+    """Whether a file name is an energy log: a .txt file, possibly compressed."""
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return name.endswith('.txt')
+
+
+def is_compressed(file_path):
+    return file_path.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_log(file_path):
+    """Open a log for reading in binary mode, decompressing .gz and .zst logs as a stream."""
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    if file_path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError("Reading .zst logs needs zstandard (pip3 install zstandard)")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), read_across_frames=True)
+        return io.BufferedReader(reader, buffer_size=1 << 18)
+    return open(file_path, 'rb')
+
+
+def read_line_chunks(file, chunk_size=1 << 18):
+    """Read a binary file in chunks of about chunk_size bytes, each ending at the end of a line."""
+    remainder = b""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        buffer = remainder + chunk
+        cut = buffer.rfind(b"\n") + 1
+        if cut:
+            yield buffer[:cut]
+        remainder = buffer[cut:]
+    if remainder:
+        yield remainder
+
+
+def _stamp(line):
+    return line.partition(b"|")[0].decode()
+
+
+def read_second_stamp(file_path):
+    """Raw timestamp of the first line after the first one that has a '|', reading only up to it."""
+    with open_log(file_path) as file:
+        for line in islice(file, 1, None):
+            if b"|" in line:
+                return _stamp(line)
+    return None
+
+
+def read_last_stamp(file_path, block_size=1 << 16):
+    """Raw timestamp of the last line that has a '|', reading the file backwards from its end.
+
+    A compressed log cannot be read backwards, so it is decompressed in one streaming pass; the
+    index keeps the result, and compressed logs no longer change.
+    """
+    if is_compressed(file_path):
+        stamp = None
+        with open_log(file_path) as file:
+            for buffer in read_line_chunks(file):
+                position = buffer.rfind(b"|")
+                if position != -1:
+                    stamp = _stamp(buffer[buffer.rfind(b"\n", 0, position) + 1:position])
+        return stamp
+
+    with open(file_path, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        partial = b""
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            file.seek(position)
+            lines = (file.read(step) + partial).split(b"\n")
+
+            # The first piece may be the end of a line that starts in an earlier block
+            partial = lines.pop(0) if position > 0 else b""
+            for line in reversed(lines):
+                if b"|" in line:
+                    return _stamp(line)
+    return None
+
+
+def read_head(file_path):
+    """The energy updates before the first cmdEndMeasurement line, and that line's raw timestamp.
+
+    This is everything complete_block_from_next_file and complete_block_from_previous_file take from
+    a file, so the rest of it is never read.  The end stamp is None if the file has no end line.
+    Only whole lines count: a last line without its newline may still be being written.
+    """
+    energies = []
+    with open_log(file_path) as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            if b"cmdUpdateEngInfo" in line:
+                energies.append(float(line.split(b"energy: ")[-1].split(b" ")[0]))
+            elif b"cmdEndMeasurement" in line:
+                return energies, _stamp(line)
+    return energies, None
@@ -0,0 +1,210 @@
+"""Incremental ingestion of energy logs that the scanners are still appending to.
+
+A checkpoint per file records its inode, the size and byte offset read so far, and the block left
+open at that offset, so each run parses only the lines appended since the last one.  Checkpoints
+are kept as JSON under ~/.cache/mri_dashboard/checkpoints (or MRI_LOG_CHECKPOINT_DIR).
+
+Run it on a log directory to print new and updated blocks as they appear:
+
+    python3 log_tail.py /path/to/logs --follow --interval 60
+"""
+from power_log_merge import iter_log_blocks, complete_block_from_adjacent_files
+from log_index import get_log_index, is_compressed, open_log, recently_modified
+from storage import CACHE_DIR, atomic_write, path_cache_file
+from datetime import datetime
+import argparse
+import json
+import time
+import os
+
+
+DEFAULT_CHECKPOINT_DIR = os.path.join(CACHE_DIR, 'checkpoints')
+
+
+def default_checkpoint_path(folder_path):
+    return path_cache_file(os.environ.get('MRI_LOG_CHECKPOINT_DIR', DEFAULT_CHECKPOINT_DIR), folder_path)
+
+
+def load_checkpoints(folder_path, checkpoint_path=None):
+    """The checkpoints of a directory, {file name: checkpoint}, or {} before its first run."""
+    try:
+        with open(checkpoint_path or default_checkpoint_path(folder_path), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_checkpoints(folder_path, checkpoints, checkpoint_path=None):
+    """Write the checkpoints atomically, so a crash never leaves half a file."""
+    checkpoint_path = checkpoint_path or default_checkpoint_path(folder_path)
+    try:
+        with atomic_write(checkpoint_path) as file:
+            json.dump(checkpoints, file)
+    except OSError as e:
+        print(f"Could not write the log checkpoints: {e}")
+
+
+def ingest_new_lines(folder_path, checkpoints, index=None):
+    """Parse what was appended to each log since its checkpoint and return {file path: new or updated blocks}.
+
+    checkpoints is updated in place.  Blocks completed since the last run and a block still open at
+    the end of a file (with end_time None) are returned; a block is identified by its start_time,
+    so a later run returning the same start_time replaces it.  Once a newer file appears, a block
+    left open at the end of the older one is completed from its neighbours as process_log_file does.
+    """
+    index = get_log_index(folder_path) if index is None else index
+    updates = {}
+
+    files = index.files()
+    for name in list(checkpoints):
+        if name not in files:
+            del checkpoints[name]
+
+    for position, name in enumerate(files):
+        file_path = os.path.join(folder_path, name)
+        blocks, checkpoint = read_new_blocks(file_path, checkpoints.get(name))
+        checkpoints[name] = checkpoint
+
+        # A newer file exists, so the block open at the end of this one continues there
+        open_block = checkpoint['open_block']
+        if open_block and not checkpoint['stitched'] and position < len(files) - 1:
+            previous_file_path, next_file_path = index.neighbours(file_path)
+            try:
+                block = complete_block_from_adjacent_files(
+                    _block_from_checkpoint(open_block), file_path, previous_file_path, next_file_path, index
+                )
+            except ValueError:
+                block = None  # the next file ends in half a line; stitch again on the next run
+
+            # Final once it has ended, or once the next file is itself finished: a newer file exists
+            # and it is no longer being written
+            finished = position < len(files) - 2 and not recently_modified(next_file_path)
+            if block and (block['end_time'] or finished):
+                blocks = [b for b in blocks if b['start_time'] != block['start_time']] + [block]
+                checkpoint['stitched'] = True
+
+        if blocks:
+            updates[file_path] = blocks
+
+    return updates
+
+
+def read_new_blocks(file_path, checkpoint=None):
+    """Parse the whole lines appended to a file since checkpoint, returning (blocks, new checkpoint).
+
+    A file whose inode changed or that got shorter has been replaced, and is read from the start.
+    A last line without its newline yet is left for the next run.  Compressed logs are read whole.
+    """
+    stat = os.stat(file_path)
+    if checkpoint is None or checkpoint['inode'] != stat.st_ino or stat.st_size < checkpoint['offset']:
+        checkpoint = {'inode': stat.st_ino, 'size': 0, 'offset': 0, 'open_block': None, 'stitched': False}
+    if stat.st_size == checkpoint['size']:
+        return [], checkpoint
+
+    # A compressed log is finished, so it is read once, whole
+    if is_compressed(file_path):
+        with open_log(file_path) as file:
+            blocks = list(iter_log_blocks(file))
+        is_open = bool(blocks) and not blocks[-1]['end_time']
+        return blocks, {
+            'inode': stat.st_ino,
+            'size': stat.st_size,
+            'offset': stat.st_size,
+            'open_block': _checkpoint_from_block(blocks[-1]) if is_open else None,
+            'stitched': False,
+        }
+
+    with open(file_path, 'rb') as file:
+        end = _end_of_last_line(file, checkpoint['offset'], stat.st_size)
+        blocks = []
+        if end > checkpoint['offset']:
+            file.seek(checkpoint['offset'])
+            open_block = checkpoint['open_block'] and _block_from_checkpoint(checkpoint['open_block'])
+            blocks = list(iter_log_blocks(_ByteRange(file, end - checkpoint['offset']), open_block))
+
+    is_open = bool(blocks) and not blocks[-1]['end_time']
+    return blocks, {
+        'inode': stat.st_ino,
+        'size': stat.st_size,
+        'offset': end,
+        'open_block': _checkpoint_from_block(blocks[-1]) if is_open else (checkpoint['open_block'] if not blocks else None),
+        'stitched': checkpoint['stitched'] if not blocks else False,
+    }
+
+
+def follow(folder_path, interval=60.0, checkpoint_path=None):
+    """Poll a directory every interval seconds, yielding the updates of each run that found any."""
+    index = get_log_index(folder_path)
+    checkpoints = load_checkpoints(folder_path, checkpoint_path)
+    while True:
+        updates = ingest_new_lines(folder_path, checkpoints, index)
+        save_checkpoints(folder_path, checkpoints, checkpoint_path)
+        index.save()
+        if updates:
+            yield updates
+        time.sleep(interval)
+
+
+def _checkpoint_from_block(block):
+    return {'start_time': block['start_time'].isoformat(), 'total_energy': block['total_energy']}
+
+
+def _block_from_checkpoint(open_block):
+    return {
+        'start_time': datetime.fromisoformat(open_block['start_time']),
+        'total_energy': open_block['total_energy'],
+        'end_time': None,
+        'duration': None,
+    }
+
+
+def _end_of_last_line(file, start, size, block_size=1 << 16):
+    """Offset just after the last newline in file[start:size], or start if there is none."""
+    position = size
+    while position > start:
+        step = min(block_size, position - start)
+        position -= step
+        file.seek(position)
+        newline = file.read(step).rfind(b"\n")
+        if newline != -1:
+            return position + newline + 1
+    return start
+
+
+class _ByteRange:
+    """The next length bytes of an open binary file, as a file iter_log_blocks can read."""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the measurement blocks appended to a directory of energy logs.")
+    parser.add_argument('folder_path')
+    parser.add_argument('--follow', action='store_true', help="keep polling the directory for new lines")
+    parser.add_argument('--interval', type=float, default=60.0, help="seconds between polls (default 60)")
+    args = parser.parse_args()
+
+    if args.follow:
+        runs = follow(args.folder_path, args.interval)
+    else:
+        checkpoints = load_checkpoints(args.folder_path)
+        runs = [ingest_new_lines(args.folder_path, checkpoints)]
+        save_checkpoints(args.folder_path, checkpoints)
+
+    for updates in runs:
+        for file_path, blocks in updates.items():
+            for block in blocks:
+                print(f"{os.path.basename(file_path)}: Start Time: {block['start_time']} - End Time: {block['end_time']} - "
+                      f"Duration: {block['duration']}s - Total Energy: {block['total_energy']} Ws")
+
+
+if __name__ == '__main__':
+    main()
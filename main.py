@@ -1,22 +1,19 @@
-import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from psycopg2 import sql
-import pandas as pd
+from db import get_connection, load_config
+from catalog import load_catalog, numeric_columns
+from export import write_batches, write_table, copy_csv, output_format, WRITERS
+from query_cache import get_cached_table
 from datetime import datetime
+import metrics
+import itertools
+import argparse
 import shutil
+import json
+import time
+import uuid
 import os
 
-info = []
-
-# Database connection parameters
-db_params = {
-    'dbname': 'mriutilisation',
-    'user': 'mridevs',
-    'password': 'qwer1234',
-    'host': 'localhost',
-    'port': 5432
-}
-
-
 def check_and_handle_directories(dir_list):
     for directory in dir_list:
         if not os.path.exists(directory):
@@ -78,35 +75,6 @@ def get_columns(cursor, schema, table):
     return cursor.fetchall()
 
 
-try:
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(**db_params)
-    cursor = conn.cursor()
-
-    # Get all schemas
-    schemas = get_schemas(cursor)
-
-    for schema_name in schemas:
-        # Initialize schema as an empty dictionary for each schema
-        schema_dict = {}
-        # Get tables in the schema
-        tables = get_tables(cursor, schema_name)
-        if tables:
-            for table in tables:
-                # Get columns for the table
-                columns = get_columns(cursor, schema_name, table)
-                schema_dict[table] = columns  # Store columns for the table in the schema
-        info.append({schema_name: schema_dict})  # Append the schema dictionary to info with schema_name as the key
-
-
-except Exception as e:
-    print(f"Error: {e}")
-finally:
-    # Close the connection
-    if conn:
-        conn.close()
-
-
 def get_valid_integer(prompt):
     while True:
         user_input = input(prompt)
@@ -117,132 +85,410 @@ def get_valid_integer(prompt):
             # Handle invalid input
             print("Invalid input. Please enter a valid integer.")
 
-# Introduction
-check_and_handle_directories([f"{os.getcwd()}/Queries"])
-print("Welcome to the MRI Dashboard Query Tool")
-print("---------------------------------------")
-print()
-print('Available scanners are:')
-for idx, i in enumerate(schemas):
-    print(f"{idx+1}. {i.upper()}")
-
-
-# Get the correct schema
-schema_check = get_valid_integer("Please select a number from the options:  ")
-print(f"You have chosen {schemas[schema_check-1]} scans")
-selected_dict_pre = info[schema_check-1]
-selected_schema = f"{schemas[schema_check-1]}"
-selected_dict = selected_dict_pre[selected_schema]
-tables_to_query = list(selected_dict.keys())
-
-
-# Get the correct tables
-print()
-print()
-print("Please select the tables you want to query.")
-for idx, i in enumerate(tables_to_query):
-    print(f"{idx+1}. {i}")
-
-selected_tables_pre = []
-print()
-table_to_choose = get_valid_integer("Please select a number from the options:  ")
-selected_tables_pre.append(tables_to_query[table_to_choose-1])
-
-
-# finished = False
-# print()
-# while finished is False:
-#     table_to_choose = get_valid_integer("Please select a number from the options:  ")
-#     selected_tables_pre.append(tables_to_query[table_to_choose-1])
-#     again = input("Table selected.  Would you like to query another table (y/n)?:  ")
-#     if again.lower() != 'y':
-#         finished = True
-
-selected_tables = list(set(selected_tables_pre))
-
-
-# Get the correct columns
-columns = ['id']
-finished = False
-for i in selected_tables:
-    print(f"From the {i} table, please select the columns you want to query.")
-    columns_to_query = list(selected_dict[i])
-    filtered_data = [tup for tup in columns_to_query if 'id' not in tup[0]]
-    for idx, j in enumerate(filtered_data):
-        print(f"{idx+1}. {j[0]}")
-    print()
-    while finished is False:
-        column_to_choose = get_valid_integer("Please select a number from the options:  ")
-        columns.append(filtered_data[column_to_choose - 1][0])
-        again = input("Column selected.  Would you like to query another column (y/n)?:  ")
-        if again.lower() != 'y':
-            finished = True
 
+# The actual query function with the information; rows are fetched DEFAULT_ITERSIZE at a time
+DEFAULT_ITERSIZE = 5000
+
+
+# Time buckets that aggregated queries can group by; any other group is a column of the table
+TIME_BUCKETS = {
+    'date': "d.date",
+    'week': "date_trunc('week', d.date)::date",
+    'month': "date_trunc('month', d.date)::date",
+}
+AGGREGATES = ('count', 'sum', 'avg')
+
+
+@metrics.timed('get_data')
+def get_data(schema, table, columns, start_date, end_date, excel_file_path, itersize=DEFAULT_ITERSIZE, fmt=None,
+             cache=False, verify_cache=False, group_by=None, aggregates=AGGREGATES):
+    """Export the chosen columns of a table for a date range; with cache, through the on-disk query cache.
 
-# The actual query function with the information
-def get_data(schema, table, columns, start_date, end_date, db_params, excel_file_path):
+    verify_cache has the cache check its dates against the database first and refetch changed ones.
+    group_by and aggregates export per-group summaries instead of rows (see build_query); they are
+    never cached.
+    """
     try:
-        # Establish a connection to the database
-        connection = psycopg2.connect(
-            host=db_params['host'],
-            dbname=db_params['dbname'],
-            user=db_params['user'],
-            password=db_params['password'],
-            port=db_params['port']
-        )
+        # Borrow a connection from the shared pool
+        with get_connection() as connection:
+            if cache and not group_by and isinstance(table, str):
+                return _get_cached_data(connection, schema, table, columns, start_date, end_date, excel_file_path, fmt,
+                                        verify_cache)
+            return _get_data(connection, schema, table, columns, start_date, end_date, excel_file_path, itersize, fmt,
+                             group_by, aggregates)
 
-        cursor = connection.cursor()
-
-        # Dynamically create the column names for the SELECT statement
-        columns_str = ", ".join([f"t.{col}" for col in columns])
-
-        # SQL query to get data for a given date range, joining with the dates table
-        query = sql.SQL("""
-            SELECT {columns}, d.date
-            FROM {schema}.{table} t
-            JOIN {schema}.dates d ON t.date_id = d.id
-            WHERE d.date BETWEEN %s AND %s
-            ORDER BY d.date;
-        """).format(
-            columns=sql.SQL(columns_str),
-            schema=sql.Identifier(schema),
-            table=sql.Identifier(table)
-        )
+    except Exception as e:
+        print(f"Error: {e}")
 
-        # Execute the query with the given parameters (start_date and end_date)
-        cursor.execute(query, (start_date, end_date))
 
-        # Fetch all results
-        data = cursor.fetchall()
+def build_query(schema, table, columns, group_by=None, aggregates=AGGREGATES, numeric=()):
+    """The query get_data runs: the chosen columns (the leading row id is not exported) and the date, for a date range.
+
+    table may be a list of tables, whose columns are then given as 'table.column' (see
+    _build_multi_table_query).  With group_by (e.g. ['month', 'protocol']) the database returns one summary row per group instead:
+    the groups, the row count, and the sum and average of each other chosen column listed in numeric,
+    as named by result_columns.  Other columns, such as text and times, are only counted in the row
+    count.  Weeks and months are given by their first day.
+    """
+    if not isinstance(table, str):
+        if group_by:
+            raise ValueError("Summaries can only be taken of one table at a time")
+        return _build_multi_table_query(schema, table, columns)
+    if group_by:
+        return _build_aggregate_query(schema, table, columns, group_by, aggregates, numeric)
+
+    columns_str = ", ".join([f"t.{col}" for col in columns[1:]] + ["d.date"])
+
+    # SQL query to get data for a given date range, joining with the dates table; ordered by id
+    # within a date so that a query cache export comes out in the same order
+    return sql.SQL("""
+        SELECT {columns}
+        FROM {schema}.{table} t
+        JOIN {schema}.dates d ON t.date_id = d.id
+        WHERE d.date BETWEEN %s AND %s
+        ORDER BY d.date, t.id;
+    """).format(
+        columns=sql.SQL(columns_str),
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table)
+    )
+
+
+def _build_multi_table_query(schema, tables, columns):
+    """One query joining every table to the dates through date_id, with the columns named 'table.column'.
+
+    Rows of different tables on the same date are paired with each other, as a merge on date_id
+    would pair them.
+    """
+    aliases = {table: f"t{idx+1}" for idx, table in enumerate(tables)}
+    selected = []
+    for column in columns[1:]:
+        table, _, name = column.rpartition('.')
+        if table not in aliases:
+            raise ValueError(f"Column '{column}' should be given as 'table.column', with table one of {', '.join(tables)}")
+        selected.append(sql.SQL("{}.{} AS {}").format(sql.Identifier(aliases[table]), sql.Identifier(name), sql.Identifier(column)))
+
+    # The database does the whole join, in one round trip
+    return sql.SQL("""
+        SELECT {selected}, d.date
+        FROM {schema}.dates d
+        {joins}
+        WHERE d.date BETWEEN %s AND %s
+        ORDER BY d.date;
+    """).format(
+        selected=sql.SQL(", ").join(selected),
+        schema=sql.Identifier(schema),
+        joins=sql.SQL("\n        ").join(
+            sql.SQL("JOIN {schema}.{table} {alias} ON {alias}.date_id = d.id").format(
+                schema=sql.Identifier(schema), table=sql.Identifier(table), alias=sql.Identifier(alias))
+            for table, alias in aliases.items()
+        )
+    )
+
+
+def _build_aggregate_query(schema, table, columns, group_by, aggregates, numeric):
+    groups = [sql.SQL(TIME_BUCKETS[group]) if group in TIME_BUCKETS else sql.SQL("t.{}").format(sql.Identifier(group))
+              for group in group_by]
+    measures = []
+    for aggregate in aggregates:
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Unsupported aggregate '{aggregate}', choose from {', '.join(AGGREGATES)}")
+        if aggregate == 'count':
+            measures.append(sql.SQL("count(*)"))
+        else:
+            measures += [sql.SQL(f"{aggregate}(t.{{}})").format(sql.Identifier(column))
+                         for column in _summed_columns(columns, group_by, numeric)]
+    names = result_columns(columns, group_by, aggregates, numeric)
+
+    # Only the summary rows leave the database
+    return sql.SQL("""
+        SELECT {selected}
+        FROM {schema}.{table} t
+        JOIN {schema}.dates d ON t.date_id = d.id
+        WHERE d.date BETWEEN %s AND %s
+        GROUP BY {groups}
+        ORDER BY {groups};
+    """).format(
+        selected=sql.SQL(", ").join(sql.SQL("{} AS {}").format(expression, sql.Identifier(name))
+                                    for expression, name in zip(groups + measures, names)),
+        groups=sql.SQL(", ").join(groups),
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table)
+    )
+
+
+def result_columns(columns, group_by=None, aggregates=AGGREGATES, numeric=()):
+    """The column names of get_data's output: e.g. month, protocol, count, sum_scan_length, avg_scan_length."""
+    if not group_by:
+        return columns[1:] + ['date']
+    names = list(group_by)
+    for aggregate in aggregates:
+        if aggregate == 'count':
+            names.append('count')
+        else:
+            names += [f"{aggregate}_{column}" for column in _summed_columns(columns, group_by, numeric)]
+    return names
+
+
+def _summed_columns(columns, group_by, numeric):
+    # sum and avg only apply to numeric columns that are not grouped by
+    return [column for column in columns[1:] if column not in group_by and column in numeric]
+
+
+def _get_data(connection, schema, table, columns, start_date, end_date, excel_file_path, itersize, fmt,
+              group_by=None, aggregates=AGGREGATES):
+    numeric = ()
+    if group_by:
+        # The catalog (cached on disk) tells which columns can be summed
+        _, info = load_catalog(connection)
+        numeric = numeric_columns(info, schema, table)
+    query = build_query(schema, table, columns, group_by, aggregates, numeric)
+
+    # CSV is produced by the server itself with COPY, bypassing Python row objects entirely
+    if output_format(excel_file_path, fmt) == 'csv':
+        with connection.cursor() as cursor:
+            rows = copy_csv(cursor, query, (start_date, end_date), excel_file_path)
+
+    else:
+        # A named cursor keeps the result on the server and fetches itersize rows per round trip
+        with connection.cursor(name=f"get_data_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = itersize
+            with metrics.timer('get_data_fetch'):
+                cursor.execute(query, (start_date, end_date))
+                first_batch = cursor.fetchmany(itersize)
+
+            # Write each batch as it arrives, so only one batch is ever held in memory
+            type_codes = [column.type_code for column in cursor.description]
+            fetches = metrics.timed_iter('get_data_fetch', iter(lambda: cursor.fetchmany(itersize), []))
+            batches = itertools.chain([first_batch], fetches)
+            rows = write_batches(excel_file_path, result_columns(columns, group_by, aggregates, numeric), batches, fmt, type_codes)
+
+    metrics.count('db_queries')
+    metrics.count('db_rows_fetched', rows)
+    if metrics.enabled:
+        metrics.count('bytes_written', os.path.getsize(excel_file_path))
+
+    # Inform the user
+    print()
+    print(f"{rows} rows of data have been saved to {excel_file_path}")
+    return rows
 
-        # Convert the data to a Pandas DataFrame
-        column_names = columns + ['date']
-        df = pd.DataFrame(data, columns=column_names)
-        df = df.drop(df.columns[0], axis=1)
 
-        # Save the DataFrame to an Excel file
-        df.to_excel(excel_file_path, index=False)
+def _get_cached_data(connection, schema, table, columns, start_date, end_date, excel_file_path, fmt, verify):
+    # Only the dates missing from the cache are fetched; the rest is read from disk
+    result = get_cached_table(connection, schema, table, columns[1:], start_date, end_date, verify)
+    rows = write_table(excel_file_path, result, fmt)
+    if metrics.enabled:
+        metrics.count('bytes_written', os.path.getsize(excel_file_path))
 
-        # Inform the user
-        print()
-        print(f"Data has been saved to {excel_file_path}")
+    # Inform the user
+    print()
+    print(f"{rows} rows of data have been saved to {excel_file_path}")
+    return rows
+
+
+def load_jobs(args, schemas):
+    """Turn the command line (a job file, or one query given by flags) into a list of export jobs."""
+    if args.job_file:
+        with open(args.job_file, 'r') as file:
+            jobs = json.load(file)
+    else:
+        jobs = [{
+            'schema': schema,
+            'table': args.table,
+            'columns': args.columns.split(','),
+            'start_date': args.start,
+            'end_date': args.end,
+            'format': args.format,
+            'cache': args.cache,
+            'group_by': args.group_by.split(',') if args.group_by else None,
+            'aggregates': args.aggregates.split(','),
+        } for schema in (schemas if args.schema.lower() == 'all' else args.schema.lower().split(','))]
+
+    for job in jobs:
+        missing = {'schema', 'table', 'columns', 'start_date', 'end_date'} - set(job)
+        if missing:
+            raise ValueError(f"Job {job} is missing {', '.join(sorted(missing))}")
+        job['schema'] = job['schema'].lower()
+        tables = job['table'].split(',') if isinstance(job['table'], str) else list(job['table'])
+        job['table'] = tables[0] if len(tables) == 1 else tables
+        job.setdefault('format', 'xlsx')
+        job.setdefault('cache', args.cache)
+    return jobs
+
+
+def job_paths(jobs, output_dir, timestamp):
+    """One output file per job, numbered where two jobs would otherwise share a name."""
+    names = [f"{timestamp}_{job['schema']}_{table_name(job['table'], '_')}_Data" for job in jobs]
+    paths = []
+    for idx, (job, name) in enumerate(zip(jobs, names)):
+        if names.count(name) > 1:
+            name = f"{name}_{idx+1}"
+        paths.append(job.get('output') or os.path.join(output_dir, f"{name}.{job['format']}"))
+    return paths
+
+
+def table_name(table, separator='+'):
+    """A table, or several joined ones, as one name."""
+    return table if isinstance(table, str) else separator.join(table)
+
+
+def run_job(job, excel_file_path):
+    """Export one job and return (job, file path, rows, seconds)."""
+    started = time.perf_counter()
+    rows = get_data(job['schema'], job['table'], ['id'] + list(job['columns']),
+                    job['start_date'], job['end_date'], excel_file_path, fmt=job['format'],
+                    cache=job['cache'], verify_cache=job.get('verify_cache', False),
+                    group_by=job.get('group_by'), aggregates=job.get('aggregates', AGGREGATES))
+    return job, excel_file_path, rows, time.perf_counter() - started
+
+
+def run_jobs(jobs, workers, output_dir='./Queries'):
+    """Run export jobs concurrently on a bounded thread pool and print a timing summary.
+
+    The exports spend their time waiting on the database, so threads overlap them; at most
+    pool_max jobs run at once because each one holds a pooled connection.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H:%M")
+    workers = max(1, min(workers or len(jobs), len(jobs), load_config()['pool_max']))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_job, jobs, job_paths(jobs, output_dir, timestamp)))
+    elapsed = time.perf_counter() - started
 
-        # Close the cursor and connection
-        cursor.close()
-        connection.close()
+    print()
+    print(f"{len(jobs)} jobs on {workers} workers in {elapsed:.1f}s")
+    for job, excel_file_path, rows, seconds in results:
+        status = f"{rows} rows" if rows is not None else "FAILED"
+        print(f"  {job['schema']}.{table_name(job['table'])}: {status} in {seconds:.1f}s -> {excel_file_path}")
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query the MRI Dashboard database.  With no arguments the tool asks for everything interactively.")
+    parser.add_argument('--job-file', help="JSON list of jobs, each with schema, table, columns, start_date, "
+                                           "end_date and optionally format and output")
+    parser.add_argument('--schema', help="scanner schema, a comma-separated list, or 'all'")
+    parser.add_argument('--table', help="table to query")
+    parser.add_argument('--columns', help="comma-separated columns to export")
+    parser.add_argument('--start', help="start date, YYYY-MM-DD")
+    parser.add_argument('--end', help="end date, YYYY-MM-DD")
+    parser.add_argument('--format', default='xlsx', choices=list(WRITERS), help="output format (default xlsx)")
+    parser.add_argument('--workers', type=int, help="number of exports to run at once (default: all of them)")
+    parser.add_argument('--output-dir', default='./Queries', help="where to write the files (default ./Queries)")
+    parser.add_argument('--group-by', help="export per-group summaries instead of rows, grouped by any of date, week, "
+                                           "month and a column, e.g. month,protocol")
+    parser.add_argument('--aggregates', default=','.join(AGGREGATES),
+                        help=f"summaries of the other columns when grouping (default {','.join(AGGREGATES)})")
+    parser.add_argument('--cache', action='store_true', help="reuse earlier results from the on-disk query cache, "
+                                                              "fetching only the dates it is missing")
+    parser.add_argument('--metrics', help="write timings and counters to this file at exit (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args(argv)
+
+    if not args.job_file and any((args.schema, args.table, args.columns, args.start, args.end)):
+        if not all((args.schema, args.table, args.columns, args.start, args.end)):
+            parser.error("--schema, --table, --columns, --start and --end are all needed without --job-file")
+    return args
+
+
+def main(argv=None):
+    """Run the batch exports given on the command line, or the interactive query tool."""
+    args = parse_args(argv)
+    if args.metrics:
+        metrics.enable(args.metrics)
+    try:
+        # Borrow a connection from the shared pool and load the schema catalog (cached on disk)
+        with get_connection() as conn:
+            schemas, info = load_catalog(conn)
 
     except Exception as e:
         print(f"Error: {e}")
+        return
+
+    # Batch mode: no prompts, every job exported in parallel
+    if args.job_file or args.schema:
+        run_jobs(load_jobs(args, schemas), args.workers, args.output_dir)
+        return
+
+    # Introduction
+    check_and_handle_directories([f"{os.getcwd()}/Queries"])
+    print("Welcome to the MRI Dashboard Query Tool")
+    print("---------------------------------------")
+    print()
+    print('Available scanners are:')
+    for idx, i in enumerate(schemas):
+        print(f"{idx+1}. {i.upper()}")
+
+
+    # Get the correct schema
+    schema_check = get_valid_integer("Please select a number from the options:  ")
+    print(f"You have chosen {schemas[schema_check-1]} scans")
+    selected_dict_pre = info[schema_check-1]
+    selected_schema = f"{schemas[schema_check-1]}"
+    selected_dict = selected_dict_pre[selected_schema]
+    tables_to_query = list(selected_dict.keys())
+
+
+    # Get the correct tables
+    print()
+    print()
+    print("Please select the tables you want to query.")
+    for idx, i in enumerate(tables_to_query):
+        print(f"{idx+1}. {i}")
+
+    selected_tables_pre = []
+    finished = False
+    print()
+    while finished is False:
+        table_to_choose = get_valid_integer("Please select a number from the options:  ")
+        selected_tables_pre.append(tables_to_query[table_to_choose-1])
+        again = input("Table selected.  Would you like to query another table (y/n)?:  ")
+        if again.lower() != 'y':
+            finished = True
+
+    # Keep the order the tables were chosen in
+    selected_tables = list(dict.fromkeys(selected_tables_pre))
 
-# Example usage
-current_datetime = datetime.now()
-formatted_datetime = current_datetime.strftime("%Y-%m-%d_%H:%M")
 
-table = selected_tables[0]
+    # Get the correct columns; with several tables they are named 'table.column'
+    columns = ['id']
+    for i in selected_tables:
+        finished = False
+        print(f"From the {i} table, please select the columns you want to query.")
+        columns_to_query = list(selected_dict[i])
+        filtered_data = [tup for tup in columns_to_query if 'id' not in tup[0]]
+        for idx, j in enumerate(filtered_data):
+            print(f"{idx+1}. {j[0]}")
+        print()
+        while finished is False:
+            column_to_choose = get_valid_integer("Please select a number from the options:  ")
+            column = filtered_data[column_to_choose - 1][0]
+            columns.append(column if len(selected_tables) == 1 else f"{i}.{column}")
+            again = input("Column selected.  Would you like to query another column (y/n)?:  ")
+            if again.lower() != 'y':
+                finished = True
+
+    # Example usage
+    current_datetime = datetime.now()
+    formatted_datetime = current_datetime.strftime("%Y-%m-%d_%H:%M")
 
-print()
-start_date = input("Please type in the start date to query in the format 'YYYY-MM-DD':  ")
-end_date = input("Please type in the end date to query in the format 'YYYY-MM-DD':  ")
-excel_file_path = f'./Queries/{formatted_datetime}_Data.xlsx'  # Specify the path where you want to save the Excel file
-get_data(selected_schema, table, columns, start_date, end_date, db_params, excel_file_path)
+    table = selected_tables[0] if len(selected_tables) == 1 else selected_tables
 
+    print()
+    start_date = input("Please type in the start date to query in the format 'YYYY-MM-DD':  ")
+    end_date = input("Please type in the end date to query in the format 'YYYY-MM-DD':  ")
+    group_by = ''
+    if isinstance(table, str):
+        group_by = input("To export totals of the numeric columns instead of rows, type what to group by (date, week, "
+                         "month and/or a column, e.g. 'month,protocol'), or press enter:  ").replace(' ', '').lower()
+    output_type = input(f"Please type in the output format ({', '.join(WRITERS)}), or press enter for xlsx:  ").strip().lower() or 'xlsx'
+    excel_file_path = f'./Queries/{formatted_datetime}_Data.{output_type}'  # Specify the path where you want to save the file
+    get_data(selected_schema, table, columns, start_date, end_date, excel_file_path,
+             group_by=group_by.split(',') if group_by else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Timers and counters for the energy and query pipelines, written as a Prometheus text file or a JSON report.
+
+Metrics are off unless enable() is called or MRI_METRICS names a report file, in which case the
+report is written when the interpreter exits (.prom for Prometheus text format, anything else JSON):
+
+    MRI_METRICS=run.prom python3 power_log_analysis.py
+
+While off, a timed function costs one flag check per call and count() returns at once, so the
+hooks can stay in the hot paths.  Metrics are kept per process; process_log_directory's workers
+do not report theirs.
+"""
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from storage import atomic_write
+import functools
+import threading
+import atexit
+import json
+import time
+import os
+
+
+PREFIX = 'mri_dashboard'
+
+enabled = False
+report_path = None
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_started = None
+_disabled_timer = nullcontext()
+
+
+def enable(path=None):
+    """Start collecting metrics, to be written to path (if given) when the interpreter exits."""
+    global enabled, report_path, _started
+    with _lock:
+        enabled = True
+        report_path = path or report_path
+        _started = _started or time.time()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    global _started
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _started = time.time() if enabled else None
+
+
+def count(name, value=1):
+    """Add value to the counter name (lines, blocks, queries, rows, bytes)."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Record one timed call of name that took seconds."""
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        timer['count'] += 1
+        timer['seconds'] += seconds
+        timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+
+def timer(name):
+    """A context manager timing its block as one call of name."""
+    if not enabled:
+        return _disabled_timer
+    return _timing(name)
+
+
+@contextmanager
+def _timing(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Decorate a function so each call is timed as name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def timed_iter(name, iterable):
+    """Yield from iterable, timing the time spent waiting for each item as name (e.g. database fetches)."""
+    if not enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            observe(name, time.perf_counter() - started)
+        yield item
+
+
+def snapshot():
+    """{'started', 'finished', 'counters', 'timers'} of everything recorded so far."""
+    with _lock:
+        return {
+            'started': datetime.fromtimestamp(_started).isoformat(timespec='seconds') if _started else None,
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'counters': dict(sorted(_counters.items())),
+            'timers': {name: dict(timer) for name, timer in sorted(_timers.items())},
+        }
+
+
+def prometheus_text(report=None):
+    """The metrics in Prometheus text exposition format, for the node_exporter textfile collector."""
+    report = report or snapshot()
+    lines = []
+    for name, value in report['counters'].items():
+        lines += [f"# TYPE {PREFIX}_{name}_total counter", f"{PREFIX}_{name}_total {value}"]
+    for name, timer in report['timers'].items():
+        lines += [
+            f"# TYPE {PREFIX}_{name}_seconds summary",
+            f"{PREFIX}_{name}_seconds_count {timer['count']}",
+            f"{PREFIX}_{name}_seconds_sum {timer['seconds']:.6f}",
+            f"# TYPE {PREFIX}_{name}_seconds_max gauge",
+            f"{PREFIX}_{name}_seconds_max {timer['max_seconds']:.6f}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(path):
+    """Write the metrics atomically to path: Prometheus text for a .prom file, a JSON run report otherwise."""
+    report = snapshot()
+    try:
+        with atomic_write(path) as file:
+            if path.endswith('.prom'):
+                file.write(prometheus_text(report))
+            else:
+                json.dump(report, file, indent=2)
+    except OSError as e:
+        print(f"Could not write the metrics: {e}")
+
+
+@atexit.register
+def _write_at_exit():
+    if enabled and report_path:
+        write_report(report_path)
+
+
+if os.environ.get('MRI_METRICS'):
+    enable(os.environ['MRI_METRICS'])
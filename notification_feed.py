@@ -0,0 +1,138 @@
+"""A small HTTP feed of the dashboard notifications, for clients that poll it often.
+
+The notifications are kept in memory with an ETag made from their version counter and served with
+ETag, Last-Modified and Cache-Control: no-cache, so a client that already has the latest version is
+answered 304 Not Modified without a body.  Each request only stats notifications.json; the file is
+read again only when an update has replaced it.
+
+write_notifications updates the file atomically and bumps the counter in notifications.json.version,
+which is written first so the server never pairs a new file with an old version.
+
+    python3 notification_feed.py /path/to/public/notifications.json --port 8765
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate, parsedate_to_datetime
+from storage import atomic_write
+import threading
+import argparse
+import json
+import os
+
+
+def version_path(notifications_path):
+    return f"{notifications_path}.version"
+
+
+def read_version(notifications_path):
+    """The version counter of a notifications file, or 0 before its first update."""
+    try:
+        with open(version_path(notifications_path), 'r') as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def write_notifications(data, notifications_path):
+    """Replace the notifications atomically and return their new version."""
+    version = read_version(notifications_path) + 1
+    with atomic_write(version_path(notifications_path)) as file:
+        file.write(str(version))
+    with atomic_write(notifications_path) as file:
+        json.dump(data, file, indent=2)
+    return version
+
+
+class NotificationFeed:
+    """The notifications file as served: its body, ETag and Last-Modified, reloaded when it is replaced."""
+
+    def __init__(self, notifications_path):
+        self.notifications_path = notifications_path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._current = None
+
+    def current(self):
+        """(body, etag, last modified timestamp) of the latest notifications."""
+        stat = os.stat(self.notifications_path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key != self._stat:
+                with open(self.notifications_path, 'rb') as file:
+                    body = file.read()
+                etag = f'"{read_version(self.notifications_path)}-{stat.st_mtime_ns:x}"'
+                self._stat, self._current = key, (body, etag, int(stat.st_mtime))
+            return self._current
+
+
+def make_handler(feed, route='/notifications.json'):
+    class FeedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != route:
+                self.send_error(404)
+                return
+            try:
+                body, etag, last_modified = feed.current()
+            except OSError as e:
+                self.send_error(503, f"Could not read the notifications: {e}")
+                return
+
+            if self.not_modified(etag, last_modified):
+                self.send_response(304)
+                self.send_headers(etag, last_modified)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_headers(etag, last_modified)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def not_modified(self, etag, last_modified):
+            # If-None-Match takes precedence over If-Modified-Since when a client sends both
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match is not None:
+                return if_none_match.strip() == '*' or etag in [i.strip() for i in if_none_match.split(',')]
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if if_modified_since:
+                try:
+                    return last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+                except (TypeError, ValueError):
+                    pass
+            return False
+
+        def send_headers(self, etag, last_modified):
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(last_modified, usegmt=True))
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+
+        def log_message(self, format, *args):
+            pass  # polled every few seconds by every open dashboard
+
+    return FeedHandler
+
+
+def serve(notifications_path, host='127.0.0.1', port=8765):
+    server = ThreadingHTTPServer((host, port), make_handler(NotificationFeed(notifications_path)))
+    print(f"Serving {notifications_path} at http://{host}:{server.server_address[1]}/notifications.json")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the dashboard notifications with ETag and Last-Modified caching.")
+    parser.add_argument('notifications_path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    serve(args.notifications_path, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
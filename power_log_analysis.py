@@ -1,8 +1,8 @@
 import os
 import time
-from datetime import datetime, timedelta, time
+from datetime import time
 from power_log_merge import process_log_file, \
-                            merge, \
+                            merge_scans, \
                             get_scan_energy, \
                             extract_scans, \
                             add_energy_column
@@ -27,11 +27,11 @@ start_time = df_scans.loc[scan_idx]['start_time']
 duration = df_scans.loc[scan_idx]['scan_length']
 protocol = df_scans.loc[scan_idx]['protocol']
 date_id = df_scans.loc[scan_idx]['date_id']
-end_time = (datetime.combine(datetime.today(), start_time) + timedelta(minutes=duration)).time()
 
 
-# Get the total energy during that protocol
-idx_1, idx_2 = merge(blocks, start_time, end_time, 1)
+# Match every scan of the day to its blocks in one sweep, then take the energy of one protocol
+matches = merge_scans(blocks, df_scans, 1)
+idx_1, idx_2 = matches[scan_idx]
 if idx_1 is not None:
 
     scan_energy = round(get_scan_energy(blocks, idx_1, idx_2), 3)
@@ -1,162 +1,545 @@
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from block_store import BlockStore, BlockIndex, EnergyTimeline, MISSING_TIME
+from log_index import get_log_index, is_compressed, open_log, read_line_chunks, read_head, read_last_stamp, read_second_stamp
+from db import get_connection
+import metrics
 from psycopg2 import sql
 import pandas as pd
 import numpy as np
-import psycopg2
+import time
+import csv
+import mmap
+import io
 import os
+import re
 
 
-def process_log_file(file_path):
+@metrics.timed('process_log_file')
+def process_log_file(file_path, index=None, use_mmap=False):
+    """Parse a log file into its blocks, completing a block left open at the end from the neighbouring files.
 
+    index is the directory's LogIndex, by default the shared one, which caches the file list and the
+    neighbour timestamps and continuations between calls and runs.  use_mmap scans a plain-text log
+    memory-mapped with scan_log_mmap, which suits very large logs.
+    """
     folder_path = os.path.dirname(file_path)
-    files_in_folder = sorted([f for f in os.listdir(folder_path) if f.endswith('.txt')])
-    current_file_index = files_in_folder.index(os.path.basename(file_path))
+    index = get_log_index(folder_path) if index is None else index
 
     # Get paths to previous and next files
-    previous_file_path = os.path.join(folder_path, files_in_folder[current_file_index - 1]) if current_file_index > 0 else None
-    next_file_path = os.path.join(folder_path, files_in_folder[current_file_index + 1]) if current_file_index < len(files_in_folder) - 1 else None
+    previous_file_path, next_file_path = index.neighbours(file_path)
+
+    # Stream the file in binary chunks (decompressing .gz/.zst logs) so no line is decoded unless it carries an event
+    if use_mmap and not is_compressed(file_path):
+        blocks = scan_log_mmap(file_path).to_blocks()
+    else:
+        with open_log(file_path) as file:
+            blocks = list(iter_log_blocks(file))
+
+    # Handle incomplete block at the end of the file
+    is_open = bool(blocks) and not blocks[-1]['end_time']
+    index.set_open_block(file_path, is_open)
+    if is_open:
+        blocks[-1] = complete_block_from_adjacent_files(
+            blocks[-1], file_path, previous_file_path, next_file_path, index
+        )
+
+    metrics.count('log_files')
+    metrics.count('log_blocks', len(blocks))
+    return blocks
+
+
+def process_log_directory(folder_path, workers=None, index=None):
+    """Parse every log in a folder (plain or compressed) on a pool of processes and return all their blocks in file order.
+
+    The result is exactly [block for path in files for block in process_log_file(path)].  Each worker
+    parses whole files; blocks left open at the end of a file are then completed here, one file at a
+    time in order, from the neighbouring files through the index.
+    """
+    index = get_log_index(folder_path) if index is None else index
+    file_paths = [os.path.join(folder_path, name) for name in index.files()]
+    if not file_paths:
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, len(file_paths))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(_parse_log_file, file_paths, chunksize=max(1, len(file_paths) // (workers * 4))))
+    else:
+        parsed = [_parse_log_file(file_path) for file_path in file_paths]
+
+    # Stitch the blocks that run across files, in file order so the result never depends on the workers
+    all_blocks = []
+    for file_path, blocks in zip(file_paths, parsed):
+        previous_file_path, next_file_path = index.neighbours(file_path)
+        is_open = bool(blocks) and not blocks[-1]['end_time']
+        index.set_open_block(file_path, is_open)
+        if is_open:
+            blocks[-1] = complete_block_from_adjacent_files(
+                blocks[-1], file_path, previous_file_path, next_file_path, index
+            )
+        all_blocks.extend(blocks)
+
+    return all_blocks
+
+
+def _parse_log_file(file_path):
+    """Parse one file without completing its last block, for process_log_directory's workers."""
+    with open_log(file_path) as file:
+        return list(iter_log_blocks(file))
+
+
+def load_block_store(file_path, use_mmap=False):
+    """Parse a log file as process_log_file does and return the blocks as a BlockStore.
+
+    With use_mmap a plain-text log is scanned by scan_log_mmap and the blocks stay arrays
+    throughout; only a block left open at the end becomes a dict, to be completed.
+    """
+    if not use_mmap or is_compressed(file_path):
+        return BlockStore.from_blocks(process_log_file(file_path))
+
+    index = get_log_index(os.path.dirname(file_path))
+    previous_file_path, next_file_path = index.neighbours(file_path)
+    store = scan_log_mmap(file_path)
+
+    # Handle incomplete block at the end of the file
+    is_open = bool(len(store)) and bool(store.end_us[-1] == MISSING_TIME)
+    index.set_open_block(file_path, is_open)
+    if is_open:
+        last = BlockStore.from_blocks([complete_block_from_adjacent_files(
+            store[-1], file_path, previous_file_path, next_file_path, index
+        )])
+        store.end_us[-1], store.energy[-1] = last.end_us[0], last.energy[0]
+
+    return store
+
+
+def scan_log_mmap(file_path):
+    """Parse a plain-text log into a BlockStore, scanning it memory-mapped.
+
+    The blocks are those of iter_log_blocks, the last one still open if the log ends inside it, but
+    the file is never copied into Python: one pass of the compiled event regex over the mapping
+    finds the start and end lines, the last cmdUpdateEngInfo line before each is found with rfind,
+    and only the timestamps and energy values are sliced out, to be decoded as arrays.
+    """
+    with open(file_path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return BlockStore()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            start_stamps, end_stamps, energies = _scan_block_events(buffer)
+            if metrics.enabled:
+                metrics.count('log_lines_parsed', sum(buffer[i:i + (1 << 24)].count(b"\n") for i in range(0, len(buffer), 1 << 24)))
+                metrics.count('log_bytes_read', len(buffer))
+
+    has_end = np.array([stamp is not None for stamp in end_stamps], dtype=bool)
+    end_us = np.full(len(end_stamps), MISSING_TIME, dtype=np.int64)
+    end_us[has_end] = parse_timestamps([stamp for stamp in end_stamps if stamp is not None]).astype(np.int64)
+    return BlockStore(
+        parse_timestamps(start_stamps).astype(np.int64),
+        end_us,
+        np.array(energies, dtype=np.float64),
+    )
+
+
+def _scan_block_events(buffer):
+    """The block state machine of _iter_chunk_blocks over a whole buffer, returning columns.
+
+    Returns the raw start and end timestamps (None for a block with no end) and the energy of
+    each block.
+    """
+    start_token, update_token = _BYTES_TOKENS[:2]
+    start_stamps, end_stamps, energies = [], [], []
+    in_block = False
+    last_update = None
+    region_start = 0
+
+    event = _BLOCK_EVENT.search(buffer)
+    while event:
+        line_start = buffer.rfind(b"\n", 0, event.start()) + 1
+        line_end = buffer.find(b"\n", event.end()) + 1 or len(buffer)
+
+        if in_block:
+            last_update = _last_line_with(buffer, update_token, region_start, line_start) or last_update
+
+        # Start of a block
+        if buffer.find(start_token, line_start, line_end) != -1:
+            if in_block:
+                end_stamps.append(None)  # Save the previous block
+                energies.append(_update_energy(last_update))
+            start_stamps.append(_raw_stamp(buffer, line_start, line_end))
+            in_block = True
+            last_update = None
+
+        # An end line that also carries an energy update counts as an update
+        elif buffer.find(update_token, line_start, line_end) != -1:
+            if in_block:
+                last_update = buffer[line_start:line_end]
+
+        # End of a block
+        elif in_block:
+            end_stamps.append(_raw_stamp(buffer, line_start, line_end))
+            energies.append(_update_energy(last_update))
+            in_block = False
+
+        region_start = line_end
+        event = _BLOCK_EVENT.search(buffer, line_end)
+
+    # Incomplete block at the end of the log
+    if in_block:
+        last_update = _last_line_with(buffer, update_token, region_start, len(buffer)) or last_update
+        end_stamps.append(None)
+        energies.append(_update_energy(last_update))
+
+    return start_stamps, end_stamps, energies
+
+
+def _raw_stamp(buffer, line_start, line_end):
+    """The bytes before the first '|' of a line, as _line_timestamp takes them."""
+    separator = buffer.find(b"|", line_start, line_end)
+    return buffer[line_start:line_end if separator == -1 else separator]
+
+
+def _update_energy(update_line):
+    """The energy of a cmdUpdateEngInfo line, or 0.0 for a block without one."""
+    if update_line is None:
+        return 0.0
+    return float(update_line.rpartition(_BYTES_TOKENS[4])[2].partition(_BYTES_TOKENS[5])[0])
+
+
+def load_energy_timeline(file_path):
+    """Read every energy sample of the blocks in a log file into an EnergyTimeline.
+
+    Samples are the cmdUpdateEngInfo lines inside a block, as process_log_file sees them, so
+    integrating from a block's start to just after its end gives that block's energy.
+    """
+    stamps, readings, block_ids = [], [], []
+    start_token, update_token = _BYTES_TOKENS[:2]
+    block_id = -1
+    in_block = False
+
+    with open_log(file_path) as file:
+        for buffer in read_line_chunks(file):
+            line_end = 0
+            for event in _ENERGY_EVENT.finditer(buffer):
+                if event.start() < line_end:
+                    continue  # a second event on a line already handled
+                line_start = buffer.rfind(b"\n", 0, event.start()) + 1
+                line_end = buffer.find(b"\n", event.end()) + 1 or len(buffer)
+                line = buffer[line_start:line_end]
+
+                if start_token in line:
+                    block_id += 1
+                    in_block = True
+                elif update_token in line:
+                    if in_block:
+                        stamps.append(line.partition(b"|")[0])
+                        readings.append(float(line.rpartition(b"energy: ")[2].partition(b" ")[0]))
+                        block_ids.append(block_id)
+                else:
+                    in_block = False
+
+    time_us = parse_timestamps(stamps).astype(np.int64)
+    return EnergyTimeline.from_readings(time_us, readings, block_ids)
+
+
+def iter_log_blocks(source, open_block=None):
+    """Yield the measurement blocks of a log in a single pass.
+
+    source is an iterable of str or bytes lines, a bytes buffer, or a file opened in binary mode.
+    Buffers and binary files are searched chunk by chunk for the start and end events, so lines in
+    between never reach Python.  Only the current block is held in memory.  A block that is still
+    open at the end of the log is yielded last with an end_time of None so the caller can complete
+    it from adjacent files.
+
+    open_block is a block left open by an earlier part of the same log, which source continues.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+
+    if hasattr(source, 'read'):
+        yield from _iter_chunk_blocks(source, open_block=open_block)
+    else:
+        yield from _iter_line_blocks(source, open_block)
+
+
+_STR_TOKENS = ("cmdStartMeasurement", "cmdUpdateEngInfo", "cmdEndMeasurement", "|", "energy: ", " ")
+_BYTES_TOKENS = tuple(token.encode() for token in _STR_TOKENS)
+_BLOCK_EVENT = re.compile(rb"cmd(?:Start|End)Measurement")
+_ENERGY_EVENT = re.compile(rb"cmd(?:StartMeasurement|UpdateEngInfo|EndMeasurement)")
+
+
+def _iter_line_blocks(lines, open_block=None):
+    """Block state machine over individual lines."""
+    current_block = open_block
+    last_update = None
+    tokens = _STR_TOKENS
+
+    for line in lines:
+        if isinstance(line, bytes) != isinstance(tokens[0], bytes):
+            tokens = _BYTES_TOKENS if isinstance(line, bytes) else _STR_TOKENS
+
+        # Start of a block
+        if tokens[0] in line:
+            if current_block:
+                yield _close_block(current_block, None, last_update, tokens)  # Save the previous block
+            current_block = _open_block(line, tokens)
+            last_update = None
+
+        # Only the last energy update of a block is kept, so defer parsing it until the block closes
+        elif tokens[1] in line and current_block:
+            last_update = line
+
+        # End of a block
+        elif tokens[2] in line and current_block:
+            yield _close_block(current_block, line, last_update, tokens)  # Finalise the block
+            current_block = None  # Reset for the next block
+
+    # Incomplete block at the end of the log
+    if current_block:
+        yield _close_block(current_block, None, last_update, tokens)
 
-    blocks = []
-    current_block = None
 
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
+def _iter_chunk_blocks(file, chunk_size=1 << 18, open_block=None):
+    """Block state machine over a binary file, read in chunks of whole lines.
+
+    Each chunk is searched for the next start or end event with one compiled regex; the energy of
+    an open block is taken from the last cmdUpdateEngInfo line before the event, found with
+    bytes.rfind.
+    """
+    start_token, update_token = _BYTES_TOKENS[:2]
+    current_block = open_block
+    last_update = None
+
+    for buffer in read_line_chunks(file, chunk_size):
+        if metrics.enabled:
+            metrics.count('log_lines_parsed', buffer.count(b"\n"))
+            metrics.count('log_bytes_read', len(buffer))
+        region_start = 0
+        event = _BLOCK_EVENT.search(buffer)
+
+        while event:
+            line_start = buffer.rfind(b"\n", 0, event.start()) + 1
+            line_end = buffer.find(b"\n", event.end()) + 1 or len(buffer)
+            line = buffer[line_start:line_end]
+
+            if current_block:
+                last_update = _last_line_with(buffer, update_token, region_start, line_start) or last_update
 
-        for i, line in enumerate(lines):
             # Start of a block
-            if "cmdStartMeasurement" in line:
+            if start_token in line:
                 if current_block:
-                    blocks.append(current_block)  # Save the previous block
-                current_block = {
-                    'start_time': parse_timestamp(line.split('|')[0]),
-                    'total_energy': 0.0,
-                    'end_time': None,
-                    'duration': None,
-                }
-
-            # Update energy info within a block
-            elif "cmdUpdateEngInfo" in line and current_block:
-                wattage = float(line.split("energy: ")[-1].split(" ")[0])
-                current_block['total_energy'] = wattage
-                #current_block['end_time'] = parse_timestamp(line.split('|')[0])  # Update end_time
+                    yield _close_block(current_block, None, last_update, _BYTES_TOKENS)  # Save the previous block
+                current_block = _open_block(line, _BYTES_TOKENS)
+                last_update = None
+
+            # An end line that also carries an energy update counts as an update
+            elif update_token in line:
+                if current_block:
+                    last_update = line
 
             # End of a block
-            elif "cmdEndMeasurement" in line and current_block:
-                current_block['end_time'] = parse_timestamp(line.split('|')[0])
-                current_block['duration'] = calculate_duration(
-                    current_block['start_time'], current_block['end_time']
-                )
-                blocks.append(current_block)  # Finalise the block
+            elif current_block:
+                yield _close_block(current_block, line, last_update, _BYTES_TOKENS)  # Finalise the block
                 current_block = None  # Reset for the next block
 
-        # Handle incomplete block at the end of the file
-        if current_block and not current_block.get('end_time'):
+            region_start = line_end
+            event = _BLOCK_EVENT.search(buffer, line_end)
 
-            current_block = complete_block_from_adjacent_files(
-                current_block, file_path, previous_file_path, next_file_path
-            )
-            blocks.append(current_block)
+        if current_block:
+            last_update = _last_line_with(buffer, update_token, region_start, len(buffer)) or last_update
 
-    return blocks
+    # Incomplete block at the end of the log
+    if current_block:
+        yield _close_block(current_block, None, last_update, _BYTES_TOKENS)
+
+
+def _last_line_with(buffer, token, start, end):
+    """Return the last whole line of buffer[start:end] that contains token, or None."""
+    position = buffer.rfind(token, start, end)
+    if position == -1:
+        return None
+    line_start = buffer.rfind(b"\n", start, position) + 1 or start
+    return buffer[line_start:buffer.find(b"\n", position, end) + 1 or end]
+
+
+def _open_block(line, tokens):
+    """Create a block from its cmdStartMeasurement line."""
+    return {
+        'start_time': _line_timestamp(line, tokens[3]),
+        'total_energy': 0.0,
+        'end_time': None,
+        'duration': None,
+    }
+
+
+def _close_block(block, end_line, update_line, tokens):
+    """Fill in the energy of a block and, given its cmdEndMeasurement line, its end time."""
+    if update_line is not None:
+        block['total_energy'] = float(update_line.rpartition(tokens[4])[2].partition(tokens[5])[0])
+    if end_line is not None:
+        block['end_time'] = _line_timestamp(end_line, tokens[3])
+        block['duration'] = calculate_duration(block['start_time'], block['end_time'])
+    return block
+
+
+def _line_timestamp(line, separator):
+    """Parse the timestamp field of a str or bytes log line."""
+    timestamp = line.partition(separator)[0]
+    if isinstance(timestamp, bytes):
+        timestamp = timestamp.decode()
+    return parse_timestamp(timestamp)
 
 
-def complete_block_from_adjacent_files(current_block, file_path, previous_file_path, next_file_path):
+@metrics.timed('complete_block_from_adjacent_files')
+def complete_block_from_adjacent_files(current_block, file_path, previous_file_path, next_file_path, index=None):
     """Check both the next and previous files for the continuation of an incomplete block."""
-    current_file_last_time = get_last_timestamp(file_path)
+    current_file_last_time = get_last_timestamp(file_path, index)
 
     # Check the next file
     if next_file_path:
-        next_file_second_time = get_second_timestamp(next_file_path)
+        next_file_second_time = get_second_timestamp(next_file_path, index)
         if next_file_second_time and time_difference_in_seconds(current_file_last_time, next_file_second_time) <= 2:
-            current_block = complete_block_from_next_file(current_block, next_file_path)
+            current_block = complete_block_from_next_file(current_block, next_file_path, index)
 
     # Check the previous file
     if previous_file_path and not current_block['end_time']:
-        previous_file_second_time = get_second_timestamp(previous_file_path)
+        previous_file_second_time = get_second_timestamp(previous_file_path, index)
 
         if previous_file_second_time and time_difference_in_seconds(current_file_last_time, previous_file_second_time) <= 2:
 
-            current_block = complete_block_from_previous_file(current_block, previous_file_path)
+            current_block = complete_block_from_previous_file(current_block, previous_file_path, index)
 
+    metrics.count('log_blocks_stitched')
     return current_block
 
 
-def complete_block_from_next_file(current_block, next_file_path):
+def complete_block_from_next_file(current_block, next_file_path, index=None):
     """Check the next file for continuation."""
-    with open(next_file_path, 'r') as next_file:
-        for line in next_file:  # Read file in natural order
-            if "cmdUpdateEngInfo" in line:
-                # Parse energy and timestamp from the line
-                timestamp = parse_timestamp(line.split('|')[0])
-                wattage = float(line.split("energy: ")[-1].split(" ")[0])
-                current_block['total_energy'] += wattage
+    return _continue_block(current_block, next_file_path, index)
 
-                # Update the block's end time based on the most recent data
-                #current_block['end_time'] = timestamp
 
-            elif "cmdEndMeasurement" in line:
-                # Set the end time to the line's timestamp
-                current_block['end_time'] = parse_timestamp(line.split('|')[0])
-
-                # Calculate the block's duration
-                current_block['duration'] = calculate_duration(
-                    current_block['start_time'], current_block['end_time']
-                )
-                return current_block  # Block is complete, exit early
+def complete_block_from_previous_file(current_block, previous_file_path, index=None):
+    """Check the previous file for continuation."""
+    return _continue_block(current_block, previous_file_path, index)
 
-    return current_block  # Return the block if no end line is found
 
+def _continue_block(current_block, file_path, index):
+    """Add the energy updates at the head of a file to the block, and end it at the file's first end line."""
+    energies, end_stamp = index.head(file_path) if index else read_head(file_path)
+    for wattage in energies:
+        current_block['total_energy'] += wattage
 
-def complete_block_from_previous_file(current_block, previous_file_path):
-    """Check the previous file for continuation."""
-    with open(previous_file_path, 'r') as previous_file:
-        for line in previous_file:  # Read file in natural order
-            if "cmdUpdateEngInfo" in line:
-                # Parse energy and timestamp from the line
-                timestamp = parse_timestamp(line.split('|')[0])
-                wattage = float(line.split("energy: ")[-1].split(" ")[0])
-                current_block['total_energy'] += wattage
+    if end_stamp is not None:
+        # Set the end time to the line's timestamp
+        current_block['end_time'] = parse_timestamp(end_stamp)
 
-                # If start time is missing, set it based on the first valid data line
-                #if current_block['start_time'] is None:
-                #    current_block['start_time'] = timestamp
+        # Calculate the block's duration
+        current_block['duration'] = calculate_duration(
+            current_block['start_time'], current_block['end_time']
+        )
 
-            elif "cmdEndMeasurement" in line:
-               # Set the end time to the line's timestamp
-                current_block['end_time'] = parse_timestamp(line.split('|')[0])
+    return current_block
 
-                # Calculate the block's duration
-                current_block['duration'] = calculate_duration(
-                    current_block['start_time'], current_block['end_time']
-                )
-                return current_block  # Block is complete, exit early
 
-    return current_block  # Return the block if no start line is found
+def get_second_timestamp(file_path, index=None):
+    """Get the timestamp of the second valid line in the file."""
+    stamp = index.second_stamp(file_path) if index else read_second_stamp(file_path)
+    return parse_timestamp(stamp) if stamp is not None else None
 
 
+def get_last_timestamp(file_path, index=None):
+    """Get the timestamp of the last valid line in the file, reading it backwards from the end."""
+    stamp = index.last_stamp(file_path) if index else read_last_stamp(file_path)
+    return parse_timestamp(stamp) if stamp is not None else None
 
-def get_second_timestamp(file_path):
-    """Get the timestamp of the second valid line in the file."""
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-        for line in lines[1:]:
-            if "|" in line:
-                return parse_timestamp(line.split('|')[0])
-    return None
 
+TIMESTAMP_FORMAT = "%Y/%m/%d-%H:%M:%S.%f"
 
-def get_last_timestamp(file_path):
-    """Get the timestamp of the last valid line in the file."""
-    with open(file_path, 'r') as file:
-        for line in reversed(file.readlines()):
-            if "|" in line:
-                return parse_timestamp(line.split('|')[0])
-    return None
+# The fixed layout the scanners write, restricted to what strptime would accept for TIMESTAMP_FORMAT
+_TIMESTAMP_LAYOUT = re.compile(
+    r"[0-9]{4}/(?:0[1-9]|1[0-2])/(?:0[1-9]|[12][0-9]|3[01])-(?:[01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]\.[0-9]{1,6}"
+)
 
 
 def parse_timestamp(timestamp):
     """Parse the timestamp from the log and return a datetime object."""
-    return datetime.strptime(timestamp, "%Y/%m/%d-%H:%M:%S.%f")
+    # Fast path: reorder the fixed-width fields into ISO form, which fromisoformat parses in C
+    if _TIMESTAMP_LAYOUT.fullmatch(timestamp):
+        try:
+            return datetime.fromisoformat(f"{timestamp[:4]}-{timestamp[5:7]}-{timestamp[8:10]}T{timestamp[11:]}")
+        except ValueError:
+            pass  # e.g. 30th February, left to strptime so the error is the same
+
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+
+def parse_timestamps(timestamps):
+    """Parse a column of log timestamps (str or bytes) into a NumPy datetime64[us] array in one go.
+
+    Stamps in the fixed layout are decoded with array arithmetic on their character codes; anything
+    else goes through parse_timestamp, so malformed stamps raise the same ValueError as strptime.
+    """
+    stamps = np.asarray(timestamps)
+    if stamps.size == 0:
+        return np.array([], dtype='M8[us]')
+    if stamps.dtype.kind == 'O':
+        stamps = stamps.astype('S' if stamps.size and isinstance(stamps.flat[0], bytes) else 'U')
+    stamps = stamps.reshape(-1)
+    if stamps.dtype.kind not in 'SU':
+        raise TypeError(f"Expected str or bytes timestamps, got {stamps.dtype}")
+
+    width = max(stamps.dtype.itemsize // (1 if stamps.dtype.kind == 'S' else 4), 26)
+    stamps = stamps.astype(f"{stamps.dtype.kind}{width}")
+    codes = stamps.view(np.uint8 if stamps.dtype.kind == 'S' else np.uint32).reshape(len(stamps), width)
+
+    # One contiguous row per character position keeps every step below a flat vector operation
+    digits = np.ascontiguousarray(codes.T[:26], dtype=np.int32) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+
+    def field(first, last):
+        value = digits[first]
+        for position in range(first + 1, last):
+            value = value * 10 + digits[position]
+        return value
+
+    # Layout: separators in place, digits in the date/time fields, then 1-6 fraction digits
+    valid = is_digit[20].copy()
+    for position, separator in ((4, '/'), (7, '/'), (10, '-'), (13, ':'), (16, ':'), (19, '.')):
+        valid &= digits[position] == ord(separator) - ord('0')
+    for position in (0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18):
+        valid &= is_digit[position]
+    fraction = digits[20].copy()
+    fraction_length = np.ones(len(stamps), dtype=np.int32)
+    for position in range(21, 26):
+        more = is_digit[position] & (fraction_length == position - 20)
+        fraction = np.where(more, fraction * 10 + digits[position], fraction)
+        fraction_length += more
+    fraction = fraction * 10 ** (6 - fraction_length)
+    valid &= (codes[:, 20:] != 0).sum(axis=1) == fraction_length
+
+    year, month, day = field(0, 4), field(5, 7), field(8, 10)
+    hour, minute, second = field(11, 13), field(14, 16), field(17, 19)
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    valid &= (hour <= 23) & (minute <= 59) & (second <= 59)
+    year, month, day, hour, minute, second, fraction = (
+        np.where(valid, value, default) for value, default in
+        ((year, 1970), (month, 1), (day, 1), (hour, 0), (minute, 0), (second, 0), (fraction, 0))
+    )
+
+    # Build the dates from the year and month, then reject days that rolled into the next month
+    month_start = (year - 1970).astype('M8[Y]').astype('M8[M]') + (month - 1)
+    dates = month_start.astype('M8[D]') + (day - 1)
+    valid &= dates.astype('M8[M]') == month_start
+
+    seconds = dates.astype(np.int64) * 86400 + (hour * 3600 + minute * 60 + second)
+    result = (seconds * 1_000_000 + fraction).astype('M8[us]')
+
+    # Anything outside the fixed layout is left to strptime
+    for i in np.flatnonzero(~valid):
+        stamp = stamps[i]
+        result[i] = np.datetime64(parse_timestamp(stamp.decode() if isinstance(stamp, bytes) else str(stamp)), 'us')
+
+    return result
 
 
 def time_difference_in_seconds(time1, time2):
@@ -171,21 +554,16 @@ def calculate_duration(start_time, end_time):
     return (end_time - start_time).total_seconds()
 
 
+@metrics.timed('extract_scans')
 def extract_scans(schema, target_date):
     """Finds the date_id for a given date and returns all scans ordered by start_time as a DataFrame."""
 
-    # Database connection parameters
-    db_params = {
-        'dbname': 'mriutilisation',
-        'user': 'mridevs',
-        'password': 'qwer1234',
-        'host': 'localhost',
-        'port': 5432
-    }
+    # Borrow a connection from the shared pool
+    with get_connection() as conn:
+        return _extract_scans(conn, schema, target_date)
 
-    # Establish a connection to the database
-    conn = psycopg2.connect(**db_params)
 
+def _extract_scans(conn, schema, target_date):
     try:
         with conn.cursor() as cur:
             # Step 1: Get the date_id for the given target_date
@@ -193,6 +571,7 @@ def extract_scans(schema, target_date):
                 SELECT id FROM {}.dates WHERE date = %s;
             """).format(sql.Identifier(schema)), (target_date,))
             result = cur.fetchone()
+            metrics.count('db_queries')
 
             if not result:
                 print(f"No matching date_id found for {target_date} in schema {schema}.")
@@ -207,6 +586,8 @@ def extract_scans(schema, target_date):
 
             columns = [desc[0] for desc in cur.description]  # Get column names
             scans = cur.fetchall()
+            metrics.count('db_queries')
+            metrics.count('db_rows_fetched', len(scans))
 
             # Convert to DataFrame
             df = pd.DataFrame(scans, columns=columns)
@@ -216,10 +597,6 @@ def extract_scans(schema, target_date):
         print(f"Error: {e}")
         return pd.DataFrame()
 
-    finally:
-        # Close the connection
-        conn.close()
-
 
 def diff_mins(block, time):
 
@@ -231,7 +608,16 @@ def diff_mins(block, time):
     return (datetime2 - datetime1).total_seconds() / 60
 
 
+@metrics.timed('merge')
 def merge(blocks, start_time, end_time, tolerance):
+    """Find the (start_idx, end_idx) of the blocks covering a scan, or (None, None).
+
+    blocks may be a BlockIndex built once for many scans; a list of blocks is scanned from the
+    start, stopping at the first match.  To match every scan of a day use merge_scans.
+    """
+    if isinstance(blocks, (BlockIndex, BlockStore)):
+        index = blocks if isinstance(blocks, BlockIndex) else BlockIndex(blocks)
+        return index.match(start_time, end_time, tolerance)
 
     start_idx = 0
 
@@ -242,7 +628,7 @@ def merge(blocks, start_time, end_time, tolerance):
             if abs(difference) < tolerance:
                 start_idx = idx
 
-        else:
+        elif block['end_time']:
             difference = diff_mins(block,  ['end_time', end_time])
             if abs(difference) < tolerance:
                 return start_idx, idx
@@ -250,6 +636,22 @@ def merge(blocks, start_time, end_time, tolerance):
     return None, None
 
 
+@metrics.timed('merge_scans')
+def merge_scans(blocks, df_scans, tolerance):
+    """Match every scan returned by extract_scans against the blocks in one sweep.
+
+    The end of each scan is its start_time plus scan_length minutes, and the (start_idx, end_idx)
+    pairs are the ones merge would give for each scan on its own.
+    """
+    start_times = list(df_scans['start_time'])
+    end_times = [
+        (datetime.combine(datetime.today(), start_time) + timedelta(minutes=float(duration))).time()
+        for start_time, duration in zip(start_times, df_scans['scan_length'])
+    ]
+    index = blocks if isinstance(blocks, BlockIndex) else BlockIndex(blocks)
+    return index.match_many(start_times, end_times, tolerance)
+
+
 def get_scan_energy(blocks, start_idx, end_idx):
 
     protocol_energy = 0
@@ -259,12 +661,17 @@ def get_scan_energy(blocks, start_idx, end_idx):
     else:
         end_range = end_idx + 1
 
+    # A BlockStore sums the energy column directly
+    if isinstance(blocks, BlockStore):
+        return blocks.total_energy(start_idx, end_range)
+
     for i in range(start_idx, end_range):
         protocol_energy += float(blocks[i]['total_energy'])
 
     return protocol_energy
 
 
+@metrics.timed('add_energy_column')
 def add_energy_column(schema, table, date_id, start_time, energy):
     """Adds an 'energy' column if missing and updates a row where date_id and start_time match."""
 
@@ -272,18 +679,12 @@ def add_energy_column(schema, table, date_id, start_time, energy):
     if isinstance(energy, (np.int64, np.float64)):
         energy = float(energy)
 
-    # Database connection parameters
-    db_params = {
-        'dbname': 'mriutilisation',
-        'user': 'mridevs',
-        'password': 'qwer1234',
-        'host': 'localhost',
-        'port': 5432
-    }
+    # Borrow a connection from the shared pool
+    with get_connection() as conn:
+        _add_energy_column(conn, schema, table, date_id, start_time, energy)
 
-    # Establish a connection to the database
-    conn = psycopg2.connect(**db_params)
 
+def _add_energy_column(conn, schema, table, date_id, start_time, energy):
     try:
         with conn.cursor() as cur:
             # Step 1: Add the 'energy' column if it doesn't exist
@@ -299,6 +700,8 @@ def add_energy_column(schema, table, date_id, start_time, energy):
                 WHERE date_id = %s AND start_time = %s;
             """).format(sql.Identifier(schema), sql.Identifier(table)),
                 (energy, date_id, start_time))
+            metrics.count('db_queries', 2)
+            metrics.count('db_rows_updated', cur.rowcount)
 
             # Commit changes
             conn.commit()
@@ -308,13 +711,75 @@ def add_energy_column(schema, table, date_id, start_time, energy):
         print(f"Error: {e}")
         conn.rollback()
 
-    finally:
-        # Close the connection
-        conn.close()
 
+@metrics.timed('add_energy_columns')
+def add_energy_columns(schema, table, rows, conn=None):
+    """Adds an 'energy' column if missing and sets it for many (date_id, start_time, energy) rows in one transaction.
+
+    The rows are copied into a temporary table shaped like the target and applied with a single
+    UPDATE ... FROM, so the column check, connection and commit happen once per batch.  Pass conn to
+    write through a specific connection (e.g. a local test database) instead of the shared pool.  Returns the number of rows
+    updated.
+    """
 
+    # Later rows win for repeated keys, as they would with one UPDATE per row
+    staged = {}
+    for date_id, start_time, energy in rows:
+        staged[(int(date_id), start_time)] = None if energy is None else float(energy)
 
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for (date_id, start_time), energy in staged.items():
+        writer.writerow((date_id, start_time, '' if energy is None else repr(energy)))
+    buffer.seek(0)
 
+    # Borrow a connection from the shared pool unless one was given
+    if conn is None:
+        with get_connection() as conn:
+            return _add_energy_columns(conn, schema, table, staged, buffer)
+    return _add_energy_columns(conn, schema, table, staged, buffer)
+
+
+def _add_energy_columns(conn, schema, table, staged, buffer):
+    started = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            # Step 1: Add the 'energy' column if it doesn't exist
+            cur.execute(sql.SQL("""
+                ALTER TABLE {}.{}
+                ADD COLUMN IF NOT EXISTS energy FLOAT;
+            """).format(sql.Identifier(schema), sql.Identifier(table)))
+
+            # Step 2: Stage the rows in a temporary table with the target's column types
+            cur.execute(sql.SQL("""
+                CREATE TEMPORARY TABLE energy_updates ON COMMIT DROP AS
+                SELECT date_id, start_time, energy FROM {}.{} WITH NO DATA;
+            """).format(sql.Identifier(schema), sql.Identifier(table)))
+            cur.copy_expert("COPY energy_updates (date_id, start_time, energy) FROM STDIN WITH (FORMAT csv)", buffer)
+
+            # Step 3: Update every matching row in one statement
+            cur.execute(sql.SQL("""
+                UPDATE {}.{} AS t
+                SET energy = u.energy
+                FROM energy_updates AS u
+                WHERE t.date_id = u.date_id AND t.start_time = u.start_time;
+            """).format(sql.Identifier(schema), sql.Identifier(table)))
+            updated = cur.rowcount
+            metrics.count('db_queries', 4)
+            metrics.count('db_rows_updated', updated)
+
+            # Commit changes
+            conn.commit()
+
+        elapsed = time.perf_counter() - started
+        print(f"Updated {schema}.{table}: set energy on {updated} of {len(staged)} rows "
+              f"in {elapsed:.2f}s ({len(staged) / elapsed:.0f} rows/s)")
+        return updated
+
+    except Exception as e:
+        print(f"Error: {e}")
+        conn.rollback()
+        return 0
 
 
 # def hamlet_add(blocks, start_idx, end_idx):
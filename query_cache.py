@@ -0,0 +1,379 @@
+"""An on-disk cache of get_data results, one Parquet file per (schema, table, column set).
+
+Each entry records which dates it covers.  A request for a date range only fetches the dates not
+covered yet and merges them in, so re-running overlapping ranges costs one small query plus the
+new days.  The latest date in the schema's dates table is never cached, as its rows may still be
+arriving.
+
+For every cached date the entry also keeps the row count and a hash of the table's rows on that
+date, computed by the database.  get_cached_table(..., verify=True) compares them with the database
+in one aggregated query and refetches the dates whose rows have changed (e.g. after
+add_energy_column); invalidate() drops dates or whole entries by hand.  Least recently used
+entries are evicted once the cache grows past max_bytes.
+
+Entries live under ~/.cache/mri_dashboard/query_cache (or MRI_QUERY_CACHE_DIR), limited to
+MRI_QUERY_CACHE_MAX_BYTES (1 GiB by default).  Clear part of it from the command line with:
+
+    python3 query_cache.py --invalidate --schema gmri3 --table scans --start 2024-01-01 --end 2024-03-31
+"""
+from datetime import date, timedelta
+from psycopg2 import sql
+from storage import CACHE_DIR, atomic_write, database_name
+from export import pa, to_arrow_table
+import threading
+import argparse
+import hashlib
+import json
+import time
+import uuid
+import os
+
+try:
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # the cache needs pyarrow, like Parquet output
+    pc = pq = None
+
+
+DEFAULT_CACHE_DIR = os.path.join(CACHE_DIR, 'query_cache')
+DEFAULT_MAX_BYTES = 1 << 30
+
+# Rows per round trip when fetching the missing dates
+FETCH_SIZE = 5000
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def cache_dir():
+    return os.environ.get('MRI_QUERY_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+
+def max_bytes():
+    return int(os.environ.get('MRI_QUERY_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+
+def get_cached_table(conn, schema, table, columns, start_date, end_date, verify=False):
+    """The rows of get_data's query (columns, then date) for [start_date, end_date] as an Arrow table.
+
+    columns excludes get_data's leading id.  Dates the cache already covers are read from disk and
+    only the others are fetched from the database, then merged into the cache.
+    """
+    if pq is None:
+        raise RuntimeError("The query cache needs pyarrow (pip3 install pyarrow)")
+    start_date, end_date = _to_date(start_date), _to_date(end_date)
+    key = _key(schema, table, columns)
+
+    with _lock(key):
+        meta = _read_meta(key) or {'schema': schema, 'table': table, 'columns': sorted(columns), 'covered': [], 'digests': {}}
+        cached = _read_table(key)
+        if cached is None:
+            meta.update(covered=[], digests={})
+
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("SELECT max(date) FROM {}.dates").format(sql.Identifier(schema)))
+            latest = cur.fetchone()[0]
+
+            changed = set()
+            if verify and meta['covered']:
+                changed = _changed_dates(cur, meta, _overlap(meta['covered'], start_date, end_date))
+                if changed:
+                    cached = _drop_dates(meta, cached, changed)
+
+            missing = _subtract(meta['covered'], start_date, end_date)
+            fetched = [_fetch(conn, schema, table, meta['columns'], first, last) for first, last in missing]
+
+            # Every date up to the day before the latest one is complete, and can be cached
+            last_complete = latest - timedelta(days=1) if latest else None
+            complete = [(first, min(last, last_complete)) for first, last in missing
+                        if last_complete and first <= last_complete]
+            for first, last in complete:
+                meta['digests'].update(_digests(cur, schema, table, first, last))
+                meta['covered'] = _add(meta['covered'], first, last)
+            if complete:
+                stored = [_between(part, None, last_complete) for part in fetched]
+                cached = _sort_by_date(_concat([cached] + stored))
+            if complete or changed:
+                _write_table(key, cached)
+        conn.rollback()
+
+        meta['used'] = time.time()
+        _write_meta(key, meta)
+
+        # The requested range: cached rows, plus fetched rows too recent to cache
+        parts = [_between(cached, start_date, end_date) if cached is not None else None]
+        parts += [_between(part, last_complete + timedelta(days=1), None) if last_complete else part for part in fetched]
+        result = _sort_by_date(_concat(parts, empty_schema=_schema_of(cached, fetched)))
+
+    evict()
+    if result is None:
+        return pa.table({name: pa.array([], pa.null()) for name in list(columns) + ['date']})
+    return result.select(list(columns) + ['date'])
+
+
+def invalidate(schema=None, table=None, start_date=None, end_date=None):
+    """Drop cached rows of every entry matching schema and table (None matches any).
+
+    With no dates whole entries are deleted; otherwise only the dates in [start_date, end_date]
+    are dropped, to be fetched again on the next request.  Returns the number of entries changed.
+    """
+    changed = 0
+    for key, meta in _entries():
+        if (schema and meta['schema'] != schema) or (table and meta['table'] != table):
+            continue
+        with _lock(key):
+            if start_date is None and end_date is None:
+                _remove(key)
+            else:
+                first, last = _to_date(start_date or date.min), _to_date(end_date or date.max)
+                meta['covered'] = _remove_interval(meta['covered'], first, last)
+                meta['digests'] = {day: digest for day, digest in meta['digests'].items()
+                                   if not first <= date.fromisoformat(day) <= last}
+                cached = _read_table(key)
+                if cached is not None:
+                    outside = pc.invert(pc.and_(pc.greater_equal(cached['date'], pa.scalar(first, pa.date32())),
+                                                pc.less_equal(cached['date'], pa.scalar(last, pa.date32()))))
+                    _write_table(key, cached.filter(outside))
+                _write_meta(key, meta)
+        changed += 1
+    return changed
+
+
+def evict(limit=None):
+    """Delete least recently used entries until the cache is no larger than limit bytes."""
+    limit = max_bytes() if limit is None else limit
+    entries = []
+    for key, meta in _entries():
+        try:
+            size = os.path.getsize(_path(key, 'parquet'))
+        except OSError:
+            size = 0
+        entries.append((meta.get('used', 0), size, key))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= limit:
+            break
+        with _lock(key):
+            _remove(key)
+        total -= size
+    return total
+
+
+def _fetch(conn, schema, table, columns, first, last):
+    """The rows of [first, last] from the database, as an Arrow table."""
+    query = sql.SQL("""
+        SELECT {columns}, d.date
+        FROM {schema}.{table} t
+        JOIN {schema}.dates d ON t.date_id = d.id
+        WHERE d.date BETWEEN %s AND %s
+        ORDER BY d.date, t.id;
+    """).format(
+        columns=sql.SQL(", ").join(sql.SQL("t.{}").format(sql.Identifier(column)) for column in columns),
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table)
+    )
+    with conn.cursor(name=f"query_cache_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = FETCH_SIZE
+        cursor.execute(query, (first, last))
+        first_batch = cursor.fetchmany(FETCH_SIZE)
+        type_codes = [column.type_code for column in cursor.description]
+        batches = [first_batch] + list(iter(lambda: cursor.fetchmany(FETCH_SIZE), []))
+    return to_arrow_table(list(columns) + ['date'], batches, type_codes)
+
+
+def _digests(cur, schema, table, first, last):
+    """{iso date: [rows, hash of the rows]} for each date in [first, last] that has rows."""
+    cur.execute(sql.SQL("""
+        SELECT d.date, count(*), sum(hashtext(t::text)::bigint)
+        FROM {schema}.{table} t
+        JOIN {schema}.dates d ON t.date_id = d.id
+        WHERE d.date BETWEEN %s AND %s
+        GROUP BY d.date;
+    """).format(schema=sql.Identifier(schema), table=sql.Identifier(table)), (first, last))
+    return {day.isoformat(): [rows, int(digest)] for day, rows, digest in cur.fetchall()}
+
+
+def _changed_dates(cur, meta, intervals):
+    """The covered dates whose rows differ from when they were cached, in one query per interval."""
+    changed = set()
+    for first, last in intervals:
+        current = _digests(cur, meta['schema'], meta['table'], first, last)
+        days = {day for day in meta['digests'] if first <= date.fromisoformat(day) <= last} | set(current)
+        changed.update(date.fromisoformat(day) for day in days if meta['digests'].get(day) != current.get(day))
+    return changed
+
+
+def _drop_dates(meta, cached, dates):
+    """Remove dates from an entry's coverage, digests and rows."""
+    for day in dates:
+        meta['covered'] = _remove_interval(meta['covered'], day, day)
+        meta['digests'].pop(day.isoformat(), None)
+    return cached.filter(pc.invert(pc.is_in(cached['date'], value_set=pa.array(sorted(dates), pa.date32()))))
+
+
+# Coverage is a sorted list of disjoint [first, last] ISO date intervals
+
+def _intervals(covered):
+    return [(date.fromisoformat(first), date.fromisoformat(last)) for first, last in covered]
+
+
+def _add(covered, first, last):
+    merged = []
+    for a, b in sorted(_intervals(covered) + [(first, last)]):
+        if merged and a <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return [[a.isoformat(), b.isoformat()] for a, b in merged]
+
+
+def _remove_interval(covered, first, last):
+    remaining = []
+    for a, b in _intervals(covered):
+        if a < first:
+            remaining.append((a, min(b, first - timedelta(days=1))))
+        if b > last:
+            remaining.append((max(a, last + timedelta(days=1)), b))
+    return [[a.isoformat(), b.isoformat()] for a, b in remaining]
+
+
+def _overlap(covered, first, last):
+    return [(max(a, first), min(b, last)) for a, b in _intervals(covered) if a <= last and b >= first]
+
+
+def _subtract(covered, first, last):
+    """The parts of [first, last] that covered does not include."""
+    missing = []
+    for a, b in _overlap(covered, first, last):
+        if a > first:
+            missing.append((first, a - timedelta(days=1)))
+        first = b + timedelta(days=1)
+    if first <= last:
+        missing.append((first, last))
+    return missing
+
+
+def _between(arrow_table, first, last):
+    mask = None
+    if first is not None:
+        mask = pc.greater_equal(arrow_table['date'], pa.scalar(first, pa.date32()))
+    if last is not None:
+        upper = pc.less_equal(arrow_table['date'], pa.scalar(last, pa.date32()))
+        mask = upper if mask is None else pc.and_(mask, upper)
+    return arrow_table if mask is None else arrow_table.filter(mask)
+
+
+def _concat(tables, empty_schema=None):
+    tables = [t for t in tables if t is not None]
+    if not tables:
+        return empty_schema.empty_table() if empty_schema is not None else None
+    return pa.concat_tables(tables, promote_options='default')
+
+
+def _sort_by_date(arrow_table):
+    # A stable sort keeps each date's rows in the order the database returned them
+    return arrow_table.take(pc.sort_indices(arrow_table, sort_keys=[('date', 'ascending')])) if arrow_table is not None else None
+
+
+def _schema_of(cached, fetched):
+    for arrow_table in [cached] + fetched:
+        if arrow_table is not None:
+            return arrow_table.schema
+    return None
+
+
+def _to_date(value):
+    return value if isinstance(value, date) else date.fromisoformat(str(value))
+
+
+def _key(schema, table, columns):
+    """The entry of a schema, table and column set (in any order) on this database."""
+    return hashlib.md5(json.dumps([database_name(), schema, table, sorted(columns)]).encode()).hexdigest()
+
+
+def _lock(key):
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _path(key, suffix):
+    return os.path.join(cache_dir(), f"{key}.{suffix}")
+
+
+def _entries():
+    try:
+        names = os.listdir(cache_dir())
+    except OSError:
+        return []
+    entries = []
+    for name in sorted(names):
+        if name.endswith('.json'):
+            meta = _read_meta(name[:-len('.json')])
+            if meta is not None:
+                entries.append((name[:-len('.json')], meta))
+    return entries
+
+
+def _read_meta(key):
+    try:
+        with open(_path(key, 'json'), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_table(key):
+    try:
+        return pq.read_table(_path(key, 'parquet'))
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+
+def _write_meta(key, meta):
+    """Write an entry's coverage atomically, so a concurrent reader never sees half a file."""
+    try:
+        with atomic_write(_path(key, 'json')) as file:
+            json.dump(meta, file)
+    except OSError as e:
+        print(f"Could not write the query cache: {e}")
+
+
+def _write_table(key, arrow_table):
+    try:
+        with atomic_write(_path(key, 'parquet'), 'wb') as file:
+            pq.write_table(arrow_table, file)
+    except OSError as e:
+        print(f"Could not write the query cache: {e}")
+
+
+def _remove(key):
+    for suffix in ('parquet', 'json'):
+        try:
+            os.remove(_path(key, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the on-disk get_data result cache.")
+    parser.add_argument('--invalidate', action='store_true', help="drop the matching entries, or only their dates in --start/--end")
+    parser.add_argument('--schema')
+    parser.add_argument('--table')
+    parser.add_argument('--start', help="first date to drop, YYYY-MM-DD")
+    parser.add_argument('--end', help="last date to drop, YYYY-MM-DD")
+    args = parser.parse_args()
+
+    if args.invalidate:
+        print(f"Invalidated {invalidate(args.schema, args.table, args.start, args.end)} cache entries")
+    for key, meta in _entries():
+        try:
+            size = os.path.getsize(_path(key, 'parquet'))
+        except OSError:
+            size = 0
+        covered = ', '.join(f"{first} to {last}" for first, last in meta['covered']) or 'nothing'
+        print(f"{meta['schema']}.{meta['table']} ({', '.join(meta['columns'])}): {size / 2 ** 20:.1f} MiB, {covered}")
+
+
+if __name__ == '__main__':
+    main()
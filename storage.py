@@ -0,0 +1,45 @@
+"""Helpers shared by the modules that keep files on disk: atomic writes, cache locations and the database name.
+
+Caches live under ~/.cache/mri_dashboard, each in its own subdirectory that an environment
+variable can move elsewhere.
+"""
+from contextlib import contextmanager
+from db import load_config
+import hashlib
+import os
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mri_dashboard')
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a temporary file next to path, and replace path with it once the block has finished.
+
+    A concurrent reader sees the old file or the new one, never half a file.  If the block raises,
+    path is left as it was.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, mode) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def path_cache_file(cache_dir, path, suffix='json'):
+    """The file in cache_dir that keeps what is cached about a file or directory, named after its absolute path."""
+    digest = hashlib.md5(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.{suffix}")
+
+
+def database_name(config=None):
+    """user@host:port/dbname of the database db.py connects to, so caches of different databases never mix."""
+    config = config or load_config()
+    return f"{config['user']}@{config['host']}:{config['port']}/{config['dbname']}"